@@ -1,8 +1,69 @@
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from memory import write_words, write_intel_hex
 assembler_log = logging.getLogger('assembler')
 
 
+def read_lines(path):
+    # lazy line reader, one line at a time without the line ending
+    with open(path) as ip:
+        for line in ip:
+            yield line.rstrip('\r\n')
+
+
+def line_chunks(path, count):
+    # splits a file into up to count (start, end) byte ranges that each begin at the start of a line
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as ip:
+        for i in range(1, count):
+            ip.seek(max(i * size // count, offsets[-1]))
+            ip.readline()
+            if ip.tell() < size and ip.tell() > offsets[-1]:
+                offsets.append(ip.tell())
+    return list(zip(offsets, offsets[1:] + [size]))
+
+
+def read_line_range(path, start, end):
+    # the lines in a byte range from line_chunks, split with universal newlines like the serial path's text mode read
+    with open(path, 'rb') as ip:
+        ip.seek(start)
+        return ip.read(end - start).decode().replace('\r\n', '\n').replace('\r', '\n').split('\n')
+
+
+def assemble_file(assembler_class, input_path, output_path, output_format='text', stream=False):
+    # runs in a worker process, returns (input path, words written, error or None) rather than raising
+    if not os.path.exists(input_path):
+        return input_path, 0, "doesn't exist, or is inaccessible"
+    try:
+        asb = assembler_class()
+        if stream:
+            count = asb.stream_assembly(input_path, output_path, output_format)
+            if count is None:
+                return input_path, 0, "nothing assembled, see the log for the reason"
+            return input_path, count, None
+        asb.input_assembly(input_path)
+        if not asb.output:
+            return input_path, 0, "nothing assembled, see the log for the reason"
+        asb.output_binary(output_path, output_format)
+        return input_path, len(asb.output), None
+    except Exception as e:
+        return input_path, 0, f"{type(e).__name__}: {e}"
+
+
+def assemble_files(assembler_class, jobs, output_format='text', workers=None, stream=False):
+    """
+    Assembles each (input path, output path) in jobs with a fresh assembler_class, spread across a process pool.
+    Returns (input path, words written, error or None) for every job, in the order the jobs were given.
+    """
+    jobs = list(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(assemble_file, assembler_class, input_path, output_path, output_format, stream)
+                   for input_path, output_path in jobs]
+        return [future.result() for future in futures]
+
+
 class Assembler:
     def __init__(self, isa):
         self.isa = isa
@@ -29,15 +90,30 @@ class Assembler:
         if self.input:
             assembler_log.info("parsing input")
 
-    def output_binary(self, path=None):
+    def stream_assembly(self, input_path, output_path, output_format='text'):
+        # assemblers that can assemble a file without holding it in memory override this, see HackAssembler
+        self.input_path = input_path
+        self.output_path = output_path
+        assembler_log.error(f"{type(self).__name__} doesn't support streaming assembly")
+        return None
+
+    def output_binary(self, path=None, output_format='text'):
         self.output_path = path
         assembler_log.info(f"attempting to write binary to {self.output_path}")
-        if self.output_path and self.input:
-            assembler_log.info(f"writing binary to file: {self.output_path}")
-            with open(self.output_path, 'w') as op:
-                for line in self.output:
-                    if self.line_breaks:
-                        op.write(str(line))
-                        op.write('\n')
-                    else:
-                        op.write(str(line))
+        if self.output_path and (self.input or self.output):
+            self.write_binary(self.output_path, self.output, output_format)
+
+    def write_binary(self, path, words, output_format='text'):
+        # output_format is 'text' (a string of '0'/'1' per word), 'raw' (packed little-endian words) or 'hex' (Intel HEX)
+        assembler_log.info(f"writing {output_format} binary to file: {path}")
+        if output_format == 'raw':
+            write_words(path, words)
+        elif output_format == 'hex':
+            write_intel_hex(path, words)
+        elif output_format == 'text':
+            width = self.isa.word_size
+            separator = '\n' if self.line_breaks else ''
+            with open(path, 'w') as op:
+                op.writelines(format(int(word), f'0{width}b') + separator for word in words)
+        else:
+            assembler_log.error(f"unknown output format {output_format}")
@@ -1,6 +1,22 @@
 import sys
 import unittest
 from collections import OrderedDict
+from functools import lru_cache
+from heapq import heappush, heappop
+from itertools import product
+
+
+# input_word() evaluates a gate bit-parallel: every input is an int whose bit k is that input's value in vector k,
+# and mask has a bit set for every vector in use
+
+
+def exactly_one(words):
+    ones = 0
+    twos = 0
+    for word in words:
+        twos |= ones & word
+        ones ^= word
+    return ones & ~twos
 
 
 class AND:
@@ -10,6 +26,12 @@ class AND:
                 return 0
         return 1
 
+    def input_word(self, _in, mask):
+        word = mask
+        for item in _in:
+            word &= item
+        return word
+
 
 class OR:
     def input(self, _in):
@@ -18,6 +40,12 @@ class OR:
                 return 1
         return 0
 
+    def input_word(self, _in, mask):
+        word = 0
+        for item in _in:
+            word |= item
+        return word
+
 
 class NOT:
     def input(self, _in):
@@ -26,6 +54,9 @@ class NOT:
         else:
             return 1
 
+    def input_word(self, _in, mask):
+        return ~_in & mask
+
 
 INV = NOT
 
@@ -36,6 +67,9 @@ class XOR:
             return 1
         return 0
 
+    def input_word(self, _in, mask):
+        return exactly_one(_in)
+
 
 class XNOR:
     def input(self, _in):
@@ -43,10 +77,47 @@ class XNOR:
             return 0
         return 1
 
+    def input_word(self, _in, mask):
+        return ~exactly_one(_in) & mask
+
+
+def pack_vectors(vectors):
+    # one word per input position, bit k of each word comes from vectors[k]
+    words = []
+    for position in range(len(vectors[0])):
+        word = 0
+        for k, vector in enumerate(vectors):
+            if vector[position]:
+                word |= 1 << k
+        words.append(word)
+    return tuple(words)
+
+
+def exhaustive_words(input_count):
+    """
+    Input words covering all 2**input_count vectors in truth table order (input 0 is the most significant), so
+    bit k of word i is bit (input_count - 1 - i) of k.
+    """
+    rows = 1 << input_count
+    words = []
+    for position in range(input_count):
+        period = 1 << (input_count - 1 - position)
+        block = ((1 << period) - 1) << period
+        words.append(block * (((1 << rows) - 1) // ((1 << (2 * period)) - 1)))
+    return tuple(words)
+
+
+# components with at most this many inputs are memoized with a full lookup table, wider ones with an LRU cache
+LOOKUP_TABLE_MAX_INPUTS = 16
+
+# component key -> lookup table, shared by every instance of a component
+lookup_tables = {}
+
 
 class Logic:
     gates = None
     netlist = None
+    lookup = None
 
     def __init__(self, gates=(), netlist=None):
         if netlist:
@@ -55,11 +126,71 @@ class Logic:
             self.gates = gates
 
     def input(self, _in):
+        if self.lookup:
+            return self.lookup(_in)
+        return self.evaluate(_in)
+
+    def evaluate(self, _in):
         if self.gates:
             return self.feed_gates(_in)
         else:
             return self.feed_netlist(_in)
 
+    def memoize(self, eager=False, cache_size=1024, input_count=None):
+        """
+        Answers input() from a lookup table indexed by the packed input bits, built all at once (eager) or one
+        entry per new input (lazy), for components with up to LOOKUP_TABLE_MAX_INPUTS inputs.  Wider components keep
+        an LRU cache of the last cache_size input tuples instead, see cache_info() for its hit and miss counts.
+        Gate chains (NAND, NOR) take any number of inputs so they need input_count, which defaults to 2.
+        """
+        if input_count is None:
+            input_count = len(self.netlist.inputs) if self.netlist else 2
+        if input_count > LOOKUP_TABLE_MAX_INPUTS:
+            self.lookup = lru_cache(maxsize=cache_size)(self.evaluate)
+            return
+        key = (self.netlist.text if self.netlist else tuple(type(gate) for gate in self.gates), input_count)
+        if key not in lookup_tables or (eager and None in lookup_tables[key]):
+            table = lookup_tables.get(key, [None] * (1 << input_count))
+            if eager:
+                rows = 1 << input_count
+                words = exhaustive_words(input_count)
+                if input_count == 1 and self.gates:
+                    words = words[0]
+                output = self.input_words(words, (1 << rows) - 1)
+                distinct = {}
+                for k in range(rows):
+                    if isinstance(output, tuple):
+                        row = tuple([(word >> k) & 1 for word in output])
+                    else:
+                        row = (output >> k) & 1
+                    table[k] = distinct.setdefault(row, row)
+            lookup_tables[key] = table
+        names = [f"n{index}" for index in range(input_count)]
+        index = ' | '.join(f"{name} << {input_count - 1 - k}" for k, name in enumerate(names))
+        lines = ["def lookup(_in):"]
+        if input_count == 1 and self.gates:
+            # unary gate chains take the bare value
+            lines.append(f"    index = _in")
+        elif input_count == 0:
+            lines.append(f"    index = 0")
+        else:
+            lines.append(f"    {''.join(name + ', ' for name in names)}= _in")
+            lines.append(f"    index = {index}")
+        lines.append("    entry = table[index]")
+        if None in lookup_tables[key]:
+            lines.append("    if entry is None:")
+            lines.append("        entry = table[index] = evaluate(_in)")
+        lines.append("    return entry")
+        namespace = {'table': lookup_tables[key], 'evaluate': self.evaluate}
+        exec('\n'.join(lines) + '\n', namespace)
+        self.lookup = namespace['lookup']
+
+    def cache_info(self):
+        # hits, misses, maxsize and currsize of the LRU cache of a wide memoized component
+        if self.lookup and hasattr(self.lookup, 'cache_info'):
+            return self.lookup.cache_info()
+        return None
+
     def feed_gates(self, _in):
         output = None
         for gate in self.gates:
@@ -70,6 +201,33 @@ class Logic:
     def feed_netlist(self, _in):
         return self.netlist.input(_in)
 
+    def input_words(self, _in, mask):
+        if self.gates:
+            output = None
+            for gate in self.gates:
+                output = gate.input_word(_in, mask)
+                _in = output
+            return output
+        else:
+            return self.netlist.input_words(_in, mask)
+
+    # gate chains like NAND can also sit inside a netlist
+    input_word = input_words
+
+    def input_batch(self, vectors):
+        """
+        Evaluates many input vectors at once with one bitwise pass over the gates, returns a list of what input()
+        would return for each vector.
+        """
+        vectors = list(vectors)
+        if not vectors:
+            return []
+        mask = (1 << len(vectors)) - 1
+        output = self.input_words(pack_vectors(vectors), mask)
+        if isinstance(output, tuple):
+            return [tuple([(word >> k) & 1 for word in output]) for k in range(len(vectors))]
+        return [(output >> k) & 1 for k in range(len(vectors))]
+
     def __str__(self):
         return str(self.netlist)
 
@@ -84,15 +242,71 @@ class NOR(Logic):
         super(NOR, self).__init__([OR(), NOT()])
 
 
+# gate lookup table for Netlist.compile(): inline python expression for each gate type, given its input variable
+# names and assuming 0/1 values.  Other gate types are compiled to an indexed read of their precomputed truth table.
+gate_expressions = {
+    AND: lambda names: ' & '.join(names),
+    OR: lambda names: ' | '.join(names),
+    NOT: lambda names: f"{names[0]} ^ 1",
+    XOR: lambda names: ' ^ '.join(names) if len(names) == 2 else f"({' + '.join(names)} == 1) + 0",
+    XNOR: lambda names: f"{' ^ '.join(names)} ^ 1" if len(names) == 2 else f"({' + '.join(names)} != 1) + 0",
+    NAND: lambda names: f"({' & '.join(names)}) ^ 1",
+    NOR: lambda names: f"({' | '.join(names)}) ^ 1",
+}
+
+# netlist text -> (function, source), shared by every instance of a component
+compiled_netlists = {}
+
+# netlist text -> parsed, flattened and levelized Netlist whose structure every instance of a component shares
+flattened_netlists = {}
+
+
 class Netlist:
-    def __init__(self, text):
+    def __init__(self, text, event_driven=False):
         self.inputs = OrderedDict()
         self.outputs = {}
         self.nets = {}
         self.gates = {}
         self.gid = 0
+        self.instances = 0
+        # evaluation schedule built by levelize(), nets are referred to by integer index
+        self.net_index = {}
+        self.schedule = []
+        self.levels = []
+        self.output_indices = ()
+        self.values = []
+        # event driven mode keeps the net values between calls and re-evaluates only the fanout of changed nets
+        self.event_driven = event_driven
+        self.fanout = []
+        self.settled = False
+        self.queued = []
+        self.evaluations = 0
+        self.text = text
+        self.function = None
+        self.source = ''
         if text:
-            self.parse(text)
+            if text in flattened_netlists:
+                self.share(flattened_netlists[text])
+            else:
+                self.parse(text)
+                flattened_netlists[text] = self
+            self.compile()
+
+    def share(self, netlist):
+        # the parsed structure is read only after levelize(), only the evaluation state is per instance
+        self.inputs = netlist.inputs
+        self.outputs = netlist.outputs
+        self.nets = netlist.nets
+        self.gates = netlist.gates
+        self.gid = netlist.gid
+        self.instances = netlist.instances
+        self.net_index = netlist.net_index
+        self.schedule = netlist.schedule
+        self.levels = netlist.levels
+        self.output_indices = netlist.output_indices
+        self.fanout = netlist.fanout
+        self.values = [None] * len(self.net_index)
+        self.queued = [False] * len(self.schedule)
 
     def parse(self, netlist):
         for line in netlist.split("\n"):
@@ -106,6 +320,8 @@ class Netlist:
                     self.process_output_line(line)
                 elif line.startswith("g"):
                     self.process_gate_line(line)
+        self.prune()
+        self.levelize()
 
     def process_input_line(self, line):
         for input_ in line.split()[1].split(','):
@@ -120,67 +336,241 @@ class Netlist:
             self.outputs[output] = None
 
     def process_gate_line(self, line):
-        gate = self.get_gate(line.split()[1])
+        gate = self.get_gate(line.split()[1])()
         inputs = line.split()[2].split(',')
         outputs = line.split()[3].split(',')
+        if isinstance(gate, Logic) and gate.netlist:
+            self.instantiate(line.split()[1], gate.netlist, inputs, outputs)
+            return
+        if len(outputs) != 1:
+            raise ValueError(f"gate {line.split()[1]} has one output, {len(outputs)} bound: {line}")
         self.gates[self.gid] = (gate, inputs, outputs)
         self.gid += 1
 
+    def instantiate(self, name, netlist, inputs, outputs):
+        """
+        Inlines the (already flattened) gates of a sub-component.  Its ports are bound positionally to the given
+        nets, '_' leaves an output unconnected, and its internal nets are renamed under a unique instance prefix.
+        """
+        if len(inputs) != len(netlist.inputs) or len(outputs) != len(netlist.outputs):
+            raise ValueError(f"{name} takes {len(netlist.inputs)} inputs and {len(netlist.outputs)} outputs, "
+                             f"{len(inputs)} and {len(outputs)} bound")
+        prefix = f"{name}{self.instances}."
+        self.instances += 1
+        rename = dict(zip(netlist.inputs, inputs))
+        for port, net in zip(netlist.outputs, outputs):
+            rename[port] = prefix + port if net == '_' else net
+        for gate, gate_inputs, gate_outputs in netlist.gates.values():
+            for net in gate_inputs + gate_outputs:
+                if net not in rename:
+                    rename[net] = prefix + net
+                    self.nets[rename[net]] = None
+            self.gates[self.gid] = (gate, [rename[i] for i in gate_inputs], [rename[o] for o in gate_outputs])
+            self.gid += 1
+
     def get_gate(self, name):
-        return getattr(sys.modules[__name__], name)
+        if hasattr(sys.modules[__name__], name):
+            return getattr(sys.modules[__name__], name)
+        # components defined in other modules
+        subclasses = list(Logic.__subclasses__())
+        while subclasses:
+            subclass = subclasses.pop()
+            if subclass.__name__ == name:
+                return subclass
+            subclasses.extend(subclass.__subclasses__())
+        raise ValueError(f"unknown gate {name}")
+
+    def prune(self):
+        # removes gates that cannot reach an output, such as the logic behind unconnected sub-component outputs
+        drivers = {}
+        for gid, (_, _, outputs) in self.gates.items():
+            for output in outputs:
+                # checked here as well as in levelize, a second driver would otherwise be pruned without a word
+                if output in drivers or output in self.inputs:
+                    raise ValueError(f"net {output} has more than one driver")
+                drivers[output] = gid
+        live = set()
+        stack = list(self.outputs)
+        while stack:
+            gid = drivers.get(stack.pop())
+            if gid is not None and gid not in live:
+                live.add(gid)
+                stack.extend(self.gates[gid][1])
+        self.gates = {gid: gate for gid, gate in self.gates.items() if gid in live}
+
+    def levelize(self):
+        """
+        Sorts the gates topologically into a flat schedule of (gate, input net indices, output net index), so input()
+        is a single pass.  Undriven nets and combinational loops are reported here rather than when evaluating.
+        """
+        self.net_index = {}
+        for name in self.inputs:
+            self.net_index[name] = len(self.net_index)
+        drivers = {}
+        for gid, (_, _, outputs) in self.gates.items():
+            for output in outputs:
+                if output in drivers or output in self.inputs:
+                    raise ValueError(f"net {output} has more than one driver")
+                drivers[output] = gid
+        for gid, (_, inputs, _) in self.gates.items():
+            for input_ in inputs:
+                if input_ not in self.inputs and input_ not in drivers:
+                    raise ValueError(f"net {input_} used by gate {gid} is never driven")
+        for output in self.outputs:
+            if output not in drivers:
+                raise ValueError(f"output {output} is never driven")
+
+        # Kahn's algorithm, one frontier per level
+        waiting = {}
+        consumers = {}
+        for gid, (_, inputs, _) in self.gates.items():
+            waiting[gid] = 0
+            for input_ in inputs:
+                if input_ not in self.inputs:
+                    waiting[gid] += 1
+                    consumers.setdefault(input_, []).append(gid)
+        frontier = [gid for gid in self.gates if waiting[gid] == 0]
+        order = []
+        level = 0
+        while frontier:
+            next_frontier = []
+            for gid in frontier:
+                order.append((gid, level))
+                for output in self.gates[gid][2]:
+                    for consumer in consumers.get(output, []):
+                        waiting[consumer] -= 1
+                        if waiting[consumer] == 0:
+                            next_frontier.append(consumer)
+            frontier = next_frontier
+            level += 1
+        if len(order) < len(self.gates):
+            looped = sorted(gid for gid in self.gates if waiting[gid])
+            raise ValueError(f"combinational loop through gates {looped}")
+
+        self.schedule = []
+        self.levels = []
+        for gid, level in order:
+            gate, inputs, outputs = self.gates[gid]
+            for output in outputs:
+                if output not in self.net_index:
+                    self.net_index[output] = len(self.net_index)
+            self.schedule.append((gate, tuple(self.net_index[i] for i in inputs), self.net_index[outputs[0]]))
+            self.levels.append(level)
+        self.output_indices = tuple(self.net_index[o] for o in self.outputs)
+        self.values = [None] * len(self.net_index)
+        self.fanout = [[] for _ in self.net_index]
+        for position, (_, inputs, _) in enumerate(self.schedule):
+            for input_ in set(inputs):
+                self.fanout[input_].append(position)
+        self.queued = [False] * len(self.schedule)
+        self.settled = False
+
+    def compile(self):
+        """
+        Generates a python function for the schedule with one local per net and one expression per gate, so input()
+        is a single call without dict lookups.  Compiled once per netlist text.
+        """
+        if self.text in compiled_netlists:
+            self.function, self.source = compiled_netlists[self.text]
+            return
+        names = [f"n{index}" for index in range(len(self.net_index))]
+        namespace = {}
+        lines = ["def netlist(_in):"]
+        if self.inputs:
+            lines.append(f"    {', '.join(names[:len(self.inputs)])}, = _in")
+        for gid, (gate, inputs, output) in enumerate(self.schedule):
+            arguments = [names[i] for i in inputs]
+            if type(gate) in gate_expressions:
+                expression = gate_expressions[type(gate)](arguments)
+            else:
+                table = tuple(gate.input(v[0] if len(v) == 1 else v) for v in product((0, 1), repeat=len(inputs)))
+                namespace[f"table_{gid}"] = table
+                index = ' | '.join(f"{name} << {len(arguments) - 1 - k}" for k, name in enumerate(arguments))
+                expression = f"table_{gid}[{index}]"
+            lines.append(f"    {names[output]} = {expression}")
+        outputs = [names[o] for o in self.output_indices]
+        lines.append(f"    return ({', '.join(outputs)}{',' if len(outputs) == 1 else ''})")
+        self.source = '\n'.join(lines) + '\n'
+        exec(self.source, namespace)
+        self.function = namespace['netlist']
+        compiled_netlists[self.text] = (self.function, self.source)
 
     def input(self, _in):
-        for index, key in enumerate(self.inputs):
-            self.inputs[key] = _in[index]
-        assert all(self.inputs), "not all inputs defined!"
-        while not self.all_keys_defined(self.outputs):
-            # print(self)
-            for gate in self.gates:
-                if self.inputs_defined(gate):
-                    # print('All inputs defined!')
-                    if self.output_to_net(gate):
-                        self.nets[self.gates[gate][2][0]] = self.gates[gate][0]().input(tuple([self.get_input_or_net_value(in_) for in_ in self.gates[gate][1]]))
-                    else:
-                        self.outputs[self.gates[gate][2][0]] = self.gates[gate][0]().input(tuple([self.get_input_or_net_value(in_) for in_ in self.gates[gate][1]]))
-
-        return_value = tuple([self.outputs[o] for o in self.outputs])
-        self.clear_ports()
-        return return_value
-
-    def output_to_net(self, gate):
-        return self.gates[gate][2][0] in self.nets
-
-    def inputs_defined(self, gate):
-        # print(gate, self.gates[gate])
-        for input_ in self.gates[gate][1]:
-            # print(input_, self.get_input_or_net_value(input_))
-            if self.get_input_or_net_value(input_) is None:
-                return False
-        return True
-
-    def get_input_or_net_value(self, signal):
-        signal_input =  self.inputs.get(signal)
-        signal_net = self.nets.get(signal)
-
-        if signal_input is not None:
-            return signal_input
-        if signal_net is not None:
-            return signal_net
-
-    def clear_ports(self):
-        for key in self.inputs:
-            self.inputs[key] = None
-        for key in self.outputs:
-            self.outputs[key] = None
-
-    def all_keys_defined(self, dictionary):
-        for key in dictionary:
-            if dictionary[key] is None:
-                return False
-        return True
+        if self.event_driven:
+            return self.propagate(_in)
+        return self.function(_in)
+
+    def propagate(self, _in):
+        """
+        Event driven evaluation: only gates downstream of inputs that changed since the last call are evaluated, in
+        schedule order.  The number of gate evaluations the call performed is left in self.evaluations.
+        """
+        if not self.settled:
+            self.evaluations = len(self.schedule)
+            return self.interpret(_in)
+        assert len(_in) == len(self.inputs), "not all inputs defined!"
+        values = self.values
+        schedule = self.schedule
+        fanout = self.fanout
+        queued = self.queued
+        pending = []
+        for index, value in enumerate(_in):
+            if values[index] != value:
+                values[index] = value
+                for position in fanout[index]:
+                    if not queued[position]:
+                        queued[position] = True
+                        heappush(pending, position)
+        evaluations = 0
+        while pending:
+            position = heappop(pending)
+            queued[position] = False
+            gate, inputs, output = schedule[position]
+            if len(inputs) == 1:
+                value = gate.input(values[inputs[0]])
+            else:
+                value = gate.input(tuple([values[i] for i in inputs]))
+            evaluations += 1
+            if value != values[output]:
+                values[output] = value
+                for consumer in fanout[output]:
+                    if not queued[consumer]:
+                        queued[consumer] = True
+                        heappush(pending, consumer)
+        self.evaluations = evaluations
+        return tuple([values[o] for o in self.output_indices])
+
+    def interpret(self, _in):
+        # walks the schedule gate by gate, the reference for the compiled function
+        assert len(_in) == len(self.inputs), "not all inputs defined!"
+        values = self.values
+        values[:len(_in)] = _in
+        for gate, inputs, output in self.schedule:
+            if len(inputs) == 1:
+                # unary gates (NOT) take the bare value
+                values[output] = gate.input(values[inputs[0]])
+            else:
+                values[output] = gate.input(tuple([values[i] for i in inputs]))
+        self.settled = True
+        return tuple([values[o] for o in self.output_indices])
+
+    def input_words(self, _in, mask):
+        assert len(_in) == len(self.inputs), "not all inputs defined!"
+        values = list(_in) + [0] * (len(self.net_index) - len(_in))
+        for gate, inputs, output in self.schedule:
+            if len(inputs) == 1:
+                values[output] = gate.input_word(values[inputs[0]], mask)
+            else:
+                values[output] = gate.input_word(tuple([values[i] for i in inputs]), mask)
+        return tuple([values[o] for o in self.output_indices])
 
     def __str__(self):
-        return f"inputs: {self.inputs}\noutputs: {self.outputs}\nnets: {self.nets}\ngates: {self.gates}"
+        # the levelized schedule, one gate per line, after pruning
+        names = {index: net for net, index in self.net_index.items()}
+        r = f"inputs: {', '.join(self.inputs)}\noutputs: {', '.join(self.outputs)}\n"
+        for (gate, inputs, output), level in zip(self.schedule, self.levels):
+            r += f"{level}: {type(gate).__name__} {','.join(names[i] for i in inputs)} {names[output]}\n"
+        return r
 
 
 class Multiplexor(Logic):
@@ -366,4 +756,165 @@ class ComponentTests(unittest.TestCase):
         self.assertEqual((0, 1), fa.input((1, 1, 0)))
         self.assertEqual((1, 1), fa.input((1, 1, 1)))
 
+    def test_netlist_schedule(self):
+        # gates listed out of order still evaluate in one pass, unary gates get the bare value
+        netlist = Netlist('''
+        i a,b
+        o q
+        n c,d
+        g NOT d q
+        g AND c,b d
+        g NOT a c
+        ''')
+        self.assertEqual([0, 1, 2], netlist.levels)
+        self.assertEqual("inputs: a, b\noutputs: q\n0: NOT a c\n1: AND c,b d\n2: NOT d q\n", str(netlist))
+        self.assertEqual((1,), netlist.input((0, 0)))
+        self.assertEqual((0,), netlist.input((0, 1)))
+        self.assertEqual((1,), netlist.input((1, 1)))
+
+    def test_netlist_errors(self):
+        with self.assertRaises(ValueError):
+            Netlist('''
+            i a
+            o q
+            n x
+            g AND a,x q
+            g AND a,q x
+            ''')
+        with self.assertRaises(ValueError):
+            Netlist('''
+            i a
+            o q
+            g AND a,x q
+            ''')
+        with self.assertRaises(ValueError):
+            Netlist('''
+            i a,b
+            o q
+            g AND a,b q
+            g OR a,b q
+            ''')
+
+    def test_input_batch(self):
+        vectors = [(a, b, c) for a in (0, 1) for b in (0, 1) for c in (0, 1)]
+        for component in (FullAdder(), HalfAdder(), NAND(), NOR()):
+            width = 3 if isinstance(component, FullAdder) else 2
+            batch = [vector[:width] for vector in vectors]
+            self.assertEqual([component.input(vector) for vector in batch], component.input_batch(batch))
+        gates = (AND(), OR(), XOR(), XNOR())
+        for gate in gates:
+            output = gate.input_word(exhaustive_words(3), 0xFF)
+            self.assertEqual([gate.input(vector) for vector in vectors], [(output >> k) & 1 for k in range(8)])
+
+    def test_exhaustive_words(self):
+        self.assertEqual((0b11110000, 0b11001100, 0b10101010), exhaustive_words(3))
+        self.assertEqual(pack_vectors([(a, b, c) for a in (0, 1) for b in (0, 1) for c in (0, 1)]), exhaustive_words(3))
+        fa = FullAdder()
+        sum_, c_out = fa.input_words(exhaustive_words(3), 0xFF)
+        self.assertEqual((0b10010110, 0b11101000), (sum_, c_out))
 
+    def test_compiled_netlist(self):
+        self.assertIs(FullAdder().netlist.function, FullAdder().netlist.function)
+        vectors = list(product((0, 1), repeat=3))
+        fa = FullAdder()
+        self.assertEqual([fa.netlist.interpret(v) for v in vectors], [fa.input(v) for v in vectors])
+        text = '''
+        i a,b,c
+        o x,y,z
+        n p
+        g NAND a,b p
+        g XOR a,b,c x
+        g XNOR p,c,a y
+        g NOR p,b z
+        '''
+        expression = gate_expressions.pop(NAND)
+        try:
+            netlist = Netlist(text)
+        finally:
+            gate_expressions[NAND] = expression
+            compiled_netlists.pop(text)
+        self.assertIn('table_0[', netlist.source)
+        self.assertEqual([netlist.interpret(v) for v in vectors], [netlist.input(v) for v in vectors])
+
+    def test_event_driven(self):
+        fa = FullAdder()
+        fa.netlist.event_driven = True
+        self.assertEqual((0, 0), fa.input((0, 0, 0)))
+        self.assertEqual(5, fa.netlist.evaluations)
+        self.assertEqual((0, 0), fa.input((0, 0, 0)))
+        self.assertEqual(0, fa.netlist.evaluations)
+        # c_in feeds the sum XOR and the carry AND, the AND output does not change so the OR is skipped
+        self.assertEqual((1, 0), fa.input((0, 0, 1)))
+        self.assertEqual(2, fa.netlist.evaluations)
+        vectors = list(product((0, 1), repeat=3))
+        for vector in vectors + vectors[::-1]:
+            self.assertEqual(FullAdder().input(vector), fa.input(vector))
+
+    def test_hierarchical_netlist(self):
+        ripple = '''
+        i a0,a1,a2,a3,b0,b1,b2,b3
+        o s0,s1,s2,s3,c4
+        n c1,c2,c3
+        g HalfAdder a0,b0 s0,c1
+        g FullAdder a1,b1,c1 s1,c2
+        g FullAdder a2,b2,c2 s2,c3
+        g FullAdder a3,b3,c3 s3,c4
+        '''
+        adder = Logic(netlist=ripple)
+        self.assertEqual(2 + 5 * 3, len(adder.netlist.schedule))
+        for a, b in product(range(16), repeat=2):
+            bits = tuple((a >> i) & 1 for i in range(4)) + tuple((b >> i) & 1 for i in range(4))
+            self.assertEqual(tuple(((a + b) >> i) & 1 for i in range(5)), adder.input(bits))
+        self.assertIs(adder.netlist.schedule, Logic(netlist=ripple).netlist.schedule)
+        # the carry logic behind an unconnected output is pruned
+        sum_only = Logic(netlist='''
+        i a,b,c
+        o s
+        g FullAdder a,b,c s,_
+        ''')
+        self.assertEqual(2, len(sum_only.netlist.schedule))
+        self.assertEqual((1,), sum_only.input((1, 1, 1)))
+        with self.assertRaises(ValueError):
+            Netlist('''
+            i a,b
+            o s
+            g FullAdder a,b s,_
+            ''')
+
+    def test_memoize(self):
+        vectors = list(product((0, 1), repeat=3))
+        expected = [FullAdder().input(vector) for vector in vectors]
+        lazy = FullAdder()
+        lazy.memoize()
+        self.assertEqual(expected, [lazy.input(vector) for vector in vectors])
+        eager = FullAdder()
+        eager.memoize(eager=True)
+        self.assertEqual(expected, [eager.input(vector) for vector in vectors])
+        self.assertNotIn(None, lookup_tables[(eager.netlist.text, 3)])
+        nand = NAND()
+        nand.memoize(eager=True, input_count=3)
+        self.assertEqual([NAND().input(vector) for vector in vectors], [nand.input(vector) for vector in vectors])
+        # 17 inputs is past the lookup table limit
+        wide = Logic(netlist='''
+        i a0,a1,a2,a3,a4,a5,a6,a7,b0,b1,b2,b3,b4,b5,b6,b7,c0
+        o s0,s7,c8
+        n c1,c2,c3,c4,c5,c6,c7
+        g FullAdder a0,b0,c0 s0,c1
+        g FullAdder a1,b1,c1 _,c2
+        g FullAdder a2,b2,c2 _,c3
+        g FullAdder a3,b3,c3 _,c4
+        g FullAdder a4,b4,c4 _,c5
+        g FullAdder a5,b5,c5 _,c6
+        g FullAdder a6,b6,c6 _,c7
+        g FullAdder a7,b7,c7 s7,c8
+        ''')
+        wide.memoize(cache_size=2)
+        ones = (1,) * 17
+        self.assertEqual((1, 1, 1), wide.input(ones))
+        self.assertEqual((1, 1, 1), wide.input(ones))
+        self.assertEqual((0, 0, 0), wide.input((0,) * 17))
+        self.assertEqual(1, wide.cache_info().hits)
+        self.assertEqual(2, wide.cache_info().misses)
+        inverter = Logic([NOT()])
+        inverter.memoize(eager=True, input_count=1)
+        self.assertEqual([1, 0], [inverter.input(0), inverter.input(1)])
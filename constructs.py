@@ -1,7 +1,92 @@
+import unittest
 from BitVector import BitVector
 from collections import deque
 
 
+class Word:
+    """
+    Immutable fixed-width word held as a plain int.  Indexing and slicing follow BitVector, index 0 is the most
+    significant bit, and + concatenates.  Convert with from_bitvector/to_bitvector at the edges only.
+    """
+    __slots__ = ('value', 'width')
+
+    def __init__(self, value=0, width=0):
+        object.__setattr__(self, 'value', value & ((1 << width) - 1))
+        object.__setattr__(self, 'width', width)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Word is immutable, can't set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Word is immutable, can't delete {name}")
+
+    @classmethod
+    def from_bitvector(cls, bv):
+        return cls(int(bv), len(bv))
+
+    def to_bitvector(self):
+        return BitVector(intVal=self.value, size=self.width)
+
+    @property
+    def signed(self):
+        # two's complement view
+        if self.width and self.value >> (self.width - 1):
+            return self.value - (1 << self.width)
+        return self.value
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __int__
+
+    def __len__(self):
+        return self.width
+
+    def __eq__(self, other):
+        if isinstance(other, Word):
+            return self.value == other.value and self.width == other.width
+        if isinstance(other, int):
+            return self.value == other
+        return NotImplemented
+
+    def __hash__(self):
+        # equal to the int of the same value, so has to hash like it
+        return hash(self.value)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.width)
+            assert step == 1, "only contiguous slices are supported"
+            length = max(stop - start, 0)
+            return Word(self.value >> (self.width - start - length), length)
+        if key < 0:
+            key += self.width
+        if not 0 <= key < self.width:
+            raise IndexError(f"bit {key} out of range for a {self.width} bit word")
+        return (self.value >> (self.width - 1 - key)) & 1
+
+    def __add__(self, other):
+        return Word((self.value << other.width) | other.value, self.width + other.width)
+
+    def __and__(self, other):
+        return Word(self.value & int(other), self.width)
+
+    def __or__(self, other):
+        return Word(self.value | int(other), self.width)
+
+    def __xor__(self, other):
+        return Word(self.value ^ int(other), self.width)
+
+    def __invert__(self):
+        return Word(~self.value, self.width)
+
+    def __str__(self):
+        return format(self.value, f'0{self.width}b') if self.width else ''
+
+    def __repr__(self):
+        return f"Word({self.value:#x}, {self.width})"
+
+
 class Queue:
     def __init__(self, name='', size=0, length=1, _in=None):
         self.name = name
@@ -9,14 +94,28 @@ class Queue:
         self.depth = length
         self.input = _in
         self.output = Wire(size=self.entry_width)
-        self.data = deque([BitVector(size=self.entry_width) for c in range(self.depth)])
+        # words are immutable, so every slot can start out as the same zero word
+        self.data = deque([Word(0, self.entry_width)] * self.depth)
 
     def set_name(self, name):
         self.name = name
 
+    def inputs(self):
+        return [self.input] if self.input else []
+
+    def compute(self):
+        return self.input.get()
+
+    def commit(self, value):
+        # the last stage drives the output, so a value latched on this edge shows after depth edges
+        self.data.appendleft(value)
+        self.data.pop()
+        self.output.set(self.data[-1])
+        # keep shifting on later edges until every stage holds the input
+        return any(entry != value for entry in self.data)
+
     def tick(self):
-        self.data.appendleft(self.input.get())
-        self.output.set(self.data.pop())
+        self.commit(self.compute())
 
     def __str__(self):
         r = f'{self.name}\n'
@@ -38,30 +137,139 @@ class Register(Queue):
 
 class Wire:
     def __init__(self, size=0):
-        self.value = BitVector(size=size)
+        self.value = Word(0, size)
+        # called with no arguments whenever the value changes, the scheduler uses this to wake the wire's sinks
+        self.listeners = []
 
     def set(self, value):
-        assert value.size == self.value.size
-        self.value = value
+        if isinstance(value, int):
+            value = Word(value, self.value.width)
+        elif not isinstance(value, Word):
+            value = Word.from_bitvector(value)
+        assert value.width == self.value.width
+        if value != self.value:
+            self.value = value
+            for listener in self.listeners:
+                listener()
 
     def get(self):
         return self.value
 
 
-# class Logic:
-#     def __init__(self, name='', cycle_delay=1, _in=None):
-#         self.name = name
-#         # self.entry_width = size
-#         # self.depth = length
-#         self.input = _in
-#         # self.output = _wire(size=self.entry_width)
-#
-#     def set_name(self, name):
-#         self.name = name
-#
-#     def tick(self):
-#         self.data.appendleft(self.input.get())
-#         self.output.set(self.data.pop())
+class Logic:
+    """
+    Combinational logic between wires that takes cycle_delay clock edges to produce its output.  function is called
+    with the Word on each input wire and returns the output as an int or Word.
+    """
+    def __init__(self, name='', cycle_delay=1, _in=None, function=None, size=0):
+        self.name = name
+        self.cycle_delay = cycle_delay
+        self.input = _in if isinstance(_in, (list, tuple)) else [_in] if _in else []
+        self.function = function
+        self.output = Wire(size=size)
+
+    def set_name(self, name):
+        self.name = name
+
+    def inputs(self):
+        return self.input
+
+    def compute(self):
+        return self.function(*[wire.get() for wire in self.input])
+
+    def commit(self, value):
+        self.output.set(value)
+        return False
+
+    def tick(self):
+        self.commit(self.compute())
+
+    def __str__(self):
+        return f'{self.name}\n{self.output.get()!s}\n'
+
+
+class Scheduler:
+    """
+    Clocks a set of components, anything with inputs(), compute() and commit(value).  Each edge first computes the
+    next state of every due component from the current wire values, then commits them all, so the result does not
+    depend on the order components were added.  Only components whose input wires changed (or that asked to run
+    again from commit) are due.  A component with a cycle_delay above 1 has its commit posted to a timing wheel
+    cycle_delay - 1 edges ahead, and run() jumps straight over edges with nothing due.
+    """
+    def __init__(self, wheel_size=64):
+        self.cycle = 0
+        self.components = []
+        self.dirty = []
+        self.due = set()
+        # slot cycle % wheel_size -> [(cycle, component, value)], events further out than the wheel wait in their slot
+        self.wheel = [[] for _ in range(wheel_size)]
+        self.pending = 0
+        self.evaluations = 0
+
+    def add(self, *components):
+        for component in components:
+            self.components.append(component)
+            for wire in component.inputs():
+                wire.listeners.append(lambda component=component: self.wake(component))
+            self.wake(component)
+
+    def wake(self, component):
+        if component not in self.due:
+            self.due.add(component)
+            self.dirty.append(component)
+
+    def schedule(self, component, value, delay):
+        self.wheel[(self.cycle + delay) % len(self.wheel)].append((self.cycle + delay, component, value))
+        self.pending += 1
+
+    def tick(self):
+        components, self.dirty = self.dirty, []
+        self.due.clear()
+        commits = []
+        for component in components:
+            value = component.compute()
+            self.evaluations += 1
+            delay = getattr(component, 'cycle_delay', 1)
+            if delay > 1:
+                self.schedule(component, value, delay - 1)
+            else:
+                commits.append((component, value))
+        if self.pending:
+            slot = self.wheel[self.cycle % len(self.wheel)]
+            if slot:
+                later = [event for event in slot if event[0] != self.cycle]
+                commits.extend((component, value) for cycle, component, value in slot if cycle == self.cycle)
+                self.pending -= len(slot) - len(later)
+                slot[:] = later
+        # wires set while committing wake their sinks for the next edge, never this one
+        for component, value in commits:
+            if component.commit(value):
+                self.wake(component)
+        self.cycle += 1
+
+    def next_event(self):
+        # earliest cycle with a commit on the wheel
+        size = len(self.wheel)
+        for offset in range(size):
+            slot = self.wheel[(self.cycle + offset) % size]
+            if any(cycle == self.cycle + offset for cycle, _, _ in slot):
+                return self.cycle + offset
+        return min(cycle for slot in self.wheel for cycle, _, _ in slot)
+
+    def run(self, cycles):
+        end = self.cycle + cycles
+        while self.cycle < end:
+            if not self.dirty:
+                if not self.pending:
+                    self.cycle = end
+                    break
+                self.cycle = min(self.next_event(), end)
+                if self.cycle == end:
+                    break
+            self.tick()
+
+    def __str__(self):
+        return f"TICK: {self.cycle}\n" + '\n'.join(str(component) for component in self.components)
 
 
 # class Mux:
@@ -70,3 +278,89 @@ class Wire:
 #
 #     def out(self, control):
 #         return self.inputs
+
+
+class WordTests(unittest.TestCase):
+    def test_word(self):
+        word = Word(0b1011000000000101, 16)
+        self.assertEqual('1011000000000101', str(word))
+        self.assertEqual(str(word.to_bitvector()), str(word))
+        self.assertEqual(word, Word.from_bitvector(word.to_bitvector()))
+        self.assertEqual(1, word[0])
+        self.assertEqual(0, word[1])
+        self.assertEqual(1, word[-1])
+        self.assertEqual(Word(0b101, 3), word[0:3])
+        self.assertEqual(Word(0b0101, 4), word[12:])
+        self.assertEqual(Word(0b1011000000000101, 16), word[0:3] + word[3:])
+        self.assertEqual(0b1011000000000101 - 0x10000, word.signed)
+        self.assertEqual(5, Word(5, 16).signed)
+        self.assertEqual(Word(0xFFFF, 16), Word(-1, 16))
+        self.assertEqual(Word(0b0100111111111010, 16), ~word)
+        self.assertEqual(hash(5), hash(Word(5, 16)))
+        self.assertEqual({5}, {Word(5, 16), 5})
+        with self.assertRaises(AttributeError):
+            word.value = 3
+        with self.assertRaises(AttributeError):
+            del word.width
+        self.assertEqual(0b1011000000000101, word.value)
+
+    def test_wire_and_register(self):
+        wire = Wire(size=16)
+        register = Register(name='r', size=16, _in=wire)
+        self.assertEqual(Word(0, 16), register.output.get())
+        wire.set(5)
+        register.tick()
+        self.assertEqual(Word(5, 16), register.output.get())
+        wire.set(BitVector(intVal=7, size=16))
+        register.tick()
+        self.assertEqual(7, register.output.get())
+        queue = Queue(name='q', size=16, length=2, _in=wire)
+        queue.tick()
+        self.assertEqual(0, queue.output.get())
+        queue.tick()
+        self.assertEqual(7, queue.output.get())
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_order_independent(self):
+        # a three stage shift register gives the same result whichever order its registers are added in
+        for reverse in (False, True):
+            wire = Wire(size=8)
+            first = Register(name='first', size=8, _in=wire)
+            second = Register(name='second', size=8, _in=first.output)
+            third = Register(name='third', size=8, _in=second.output)
+            scheduler = Scheduler()
+            scheduler.add(*([third, second, first] if reverse else [first, second, third]))
+            outputs = []
+            for value in range(1, 8):
+                wire.set(value)
+                scheduler.tick()
+                outputs.append(int(third.output.get()))
+            self.assertEqual([0, 0, 1, 2, 3, 4, 5], outputs)
+
+    def test_idle_components_skipped(self):
+        wire = Wire(size=8)
+        registers = [Register(name=str(i), size=8, _in=wire) for i in range(10)]
+        scheduler = Scheduler()
+        scheduler.add(*registers)
+        scheduler.run(1000)
+        self.assertEqual(1000, scheduler.cycle)
+        self.assertEqual(10, scheduler.evaluations)
+        wire.set(3)
+        scheduler.run(1000)
+        self.assertEqual(20, scheduler.evaluations)
+        self.assertTrue(all(register.output.get() == 3 for register in registers))
+
+    def test_cycle_delay(self):
+        wire = Wire(size=8)
+        multiply = Logic(name='multiply', cycle_delay=100, _in=wire, function=lambda x: int(x) * 3, size=8)
+        scheduler = Scheduler(wheel_size=16)
+        scheduler.add(multiply)
+        wire.set(5)
+        scheduler.tick()
+        scheduler.run(98)
+        self.assertEqual(0, multiply.output.get())
+        scheduler.run(1)
+        self.assertEqual(15, multiply.output.get())
+        self.assertEqual(1, scheduler.evaluations)
+        self.assertEqual(0, scheduler.pending)
@@ -0,0 +1,70 @@
+import os
+import logging
+from memory import map_words, read_words, read_intel_hex, binary_formats
+emulator_log = logging.getLogger('emulator')
+
+
+class Emulator:
+    def __init__(self, isa):
+        self.isa = isa
+        self.input_path = None
+        self.cycles = 0
+        self.halted = False
+
+    def input_binary(self, path=None, input_format=None):
+        # reads any format Assembler.output_binary writes, by default picked by the file extension
+        self.input_path = path
+        emulator_log.info(f"checking input file {self.input_path}")
+        if self.input_path:
+            if os.path.exists(self.input_path):
+                if input_format is None:
+                    input_format = binary_formats.get(os.path.splitext(self.input_path)[1], 'text')
+                if input_format == 'raw':
+                    self.load_program(read_words(self.input_path))
+                elif input_format == 'hex':
+                    self.load_program(read_intel_hex(self.input_path))
+                else:
+                    # text, with or without line breaks
+                    with open(self.input_path) as ip:
+                        bits = ''.join(ip.read().split())
+                    width = self.isa.word_size
+                    self.load_program([int(bits[i:i + width], 2) for i in range(0, len(bits), width)])
+            else:
+                emulator_log.error(f"{self.input_path} doesn't exist, or is inaccessible")
+        else:
+            emulator_log.error("no input file given")
+
+    def input_image(self, path=None):
+        # packed little-endian words as written by memory.write_words, mapped rather than read and parsed
+        self.input_path = path
+        emulator_log.info(f"checking input image {self.input_path}")
+        if self.input_path:
+            if os.path.exists(self.input_path):
+                self.load_program(map_words(self.input_path))
+            else:
+                emulator_log.error(f"{self.input_path} doesn't exist, or is inaccessible")
+        else:
+            emulator_log.error("no input file given")
+
+    def load_assembler(self, assembler):
+        if assembler.output:
+            self.load_program(assembler.output)
+        else:
+            emulator_log.error("assembler has no output to load")
+
+    def load_program(self, program):
+        # program = iterable of words, either BitVectors or ints, or an array or memoryview of unsigned shorts
+        emulator_log.info("loading program")
+
+    def reset(self):
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles=None):
+        return 0
+
+    def dump_state(self):
+        return f"cycles: {self.cycles}\nhalted: {self.halted}"
+
+    def __str__(self):
+        return self.dump_state()
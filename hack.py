@@ -1,13 +1,22 @@
 import argparse
 import os
+import tempfile
+import unittest
+from array import array
+from itertools import permutations, repeat
 
 from isa import Isa
-from assembler import Assembler
+from concurrent.futures import ProcessPoolExecutor
+
+from assembler import Assembler, assemble_file, assemble_files, line_chunks, read_line_range, read_lines
+from memory import format_extensions, read_words
 import logging
 from BitVector import BitVector
-import copy
 hack_log = logging.getLogger('hack')
 
+# intermediate between the passes of a streaming assembly is kept in memory up to this many characters
+SPOOL_SIZE = 1 << 20
+
 
 class Hack(Isa):
     def __init__(self):
@@ -99,126 +108,327 @@ class Hack(Isa):
         self.starting_variable_allocation_address = 16
 
 
+# full C-instruction text -> encoded word, built on first use
+c_instruction_words = {}
+
+
+def build_c_instruction_words(isa):
+    """
+    Every spelling of every C-instruction mapped straight to its 16 bit word: destinations in any register order (MD
+    and DM) and the commutative comps with their operands swapped (D+A and A+D), with null dest and jump omitted.
+    """
+    opcode = int(isa.opcode_map['C'][0]) << 13
+    comps = {}
+    for comp, bv in isa.comp_map.items():
+        comps[comp] = int(bv)
+        for operator in '+&|':
+            if len(comp) == 3 and comp[1] == operator and comp[0] != comp[2] and comp[2] in 'ADM':
+                comps.setdefault(comp[2] + operator + comp[0], int(bv))
+    dests = {}
+    for dest, bv in isa.dest_map.items():
+        for spelling in [''] if dest == 'null' else (''.join(p) + '=' for p in permutations(dest)):
+            dests[spelling] = int(bv)
+    jumps = {('' if jump == 'null' else ';' + jump): int(bv) for jump, bv in isa.jump_map.items()}
+    for comp, comp_bits in comps.items():
+        for dest, dest_bits in dests.items():
+            for jump, jump_bits in jumps.items():
+                c_instruction_words[dest + comp + jump] = opcode | comp_bits << 6 | dest_bits << 3 | jump_bits
+
+
+# output format -> file extension, the binary formats use memory's so emulators can tell them apart
+output_extensions = {'text': '.hack', **format_extensions}
+
+
+def first_pass_chunk(path, start, end):
+    """
+    First pass over one chunk of a file in a worker process.  Returns the chunk's instruction count, its labels at
+    addresses relative to the chunk, and the symbols its A-instructions use in order of first use, which are later
+    either labels, predefined or variables.
+    """
+    asb = HackAssembler()
+    asb.symbol_table = {}
+    count = 0
+    references = {}
+    for instruction in asb.first_pass(read_line_range(path, start, end)):
+        count += 1
+        if instruction.startswith('@') and not instruction[1:].isdigit():
+            references[instruction[1:]] = None
+    return count, asb.symbol_table, list(references)
+
+
+def second_pass_chunk(path, start, end, symbol_table, base=0):
+    # second pass over one chunk against the complete symbol table, base is the chunk's first instruction's index
+    asb = HackAssembler()
+    asb.symbol_table = symbol_table
+    return array('H', asb.second_pass(asb.first_pass(read_line_range(path, start, end)), base)).tobytes()
+
+
 class HackAssembler(Assembler):
     def __init__(self):
         super(HackAssembler, self).__init__(Hack())
         self.symbol_table = {}
         self.load_symbol_table()
+        self.next_available_address = self.isa.starting_variable_allocation_address
         self.line_breaks = True
+        if not c_instruction_words:
+            build_c_instruction_words(self.isa)
+        self.a_opcode = int(self.isa.opcode_map['A'][0]) << 15
 
     def load_symbol_table(self):
         self.symbol_table.clear()
-        self.symbol_table = copy.deepcopy(self.isa.predefined_symbols)
+        # symbols map to ints, a shallow copy is enough
+        self.symbol_table = dict(self.isa.predefined_symbols)
 
     def parse_assembly(self):
         hack_log.info('applying the hack assembly format to input')
-        self.output = []
-        instruction_count = 0
-        output_bitlines = []
-        # print(self.symbol_table)
-        input_post_first_pass = []
-        for line in self.input:
-            line = line.strip()
+        # the first pass has to finish, defining every label, before the second starts
+        instructions = list(self.first_pass(self.input))
+        try:
+            self.output = array('H', self.second_pass(instructions))
+        except ValueError as e:
+            hack_log.fatal(e)
+            self.output = array('H')
+
+    def stream_assembly(self, input_path, output_path, output_format='text'):
+        """
+        Assembles input_path into output_path without holding either in memory: a first pass over the lazily read
+        lines resolves labels and spools the remaining instructions, a second pass encodes the spool, and the words
+        are written as they are produced, to a temporary file renamed over output_path only once every instruction
+        has encoded.  Returns the number of instructions assembled, or None if nothing was written.
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        hack_log.info(f"streaming {self.input_path} to {self.output_path}")
+        if not os.path.exists(self.input_path):
+            hack_log.error(f"{self.input_path} doesn't exist, or is inaccessible")
+            return None
+        fd, partial_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.output_path)),
+                                            prefix=os.path.basename(self.output_path), suffix='.partial')
+        os.close(fd)
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+') as spool:
+                count = 0
+                for instruction in self.first_pass(read_lines(self.input_path)):
+                    spool.write(f"{instruction}\n")
+                    count += 1
+                spool.seek(0)
+                self.write_binary(partial_path, self.second_pass(line.rstrip('\n') for line in spool), output_format)
+            os.replace(partial_path, self.output_path)
+        except ValueError as e:
+            hack_log.fatal(e)
+            return None
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        return count
+
+    def parallel_assembly(self, path, workers=None, chunk_count=None):
+        """
+        Assembles one large file with both passes split into chunks run in a process pool.  Chunk labels are placed
+        by a prefix sum over the chunk instruction counts, and variables are allocated walking the chunks' symbol
+        uses in file order, so the output is identical to parse_assembly's.
+        """
+        self.input_path = path
+        hack_log.info(f"assembling {path} in parallel")
+        if not os.path.exists(path):
+            hack_log.error(f"{path} doesn't exist, or is inaccessible")
+            return None
+        workers = workers or os.cpu_count()
+        chunks = line_chunks(path, chunk_count or 2 * workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            first_passes = list(executor.map(first_pass_chunk, repeat(path), *zip(*chunks)))
+            base = 0
+            bases = []
+            references = []
+            for count, labels, symbols in first_passes:
+                for label, address in labels.items():
+                    if label not in self.symbol_table:
+                        self.symbol_table[label] = base + address
+                references.extend(symbols)
+                bases.append(base)
+                base += count
+            self.next_available_address = self.isa.starting_variable_allocation_address
+            for symbol in references:
+                if symbol not in self.symbol_table:
+                    self.symbol_table[symbol] = self.next_available_address
+                    self.next_available_address += 1
+            self.output = array('H')
+            try:
+                for words in executor.map(second_pass_chunk, repeat(path), *zip(*chunks), repeat(self.symbol_table),
+                                          bases):
+                    self.output.frombytes(words)
+            except ValueError as e:
+                hack_log.fatal(e)
+                self.output = array('H')
+        return self.output
+
+    @staticmethod
+    def strip_comments(lines):
+        for line in lines:
+            line = line.split('//')[0].strip()
             if line:
-                removed_comments = line.strip().split('//')[0].strip()
-                if removed_comments:
-                    if line.startswith('('):
-                        label = line.split('(')[1].split(')')[0].strip()
-                        # print(f"Label {label} detected at line {instruction_count + 1}")
-                        if label in self.symbol_table:
-                            # print("\tSymbol already defined, skipping")
-                            pass
-                        else:
-                            self.symbol_table[label] = instruction_count
-                            # print(f"\tAdding {label} to table at instruction {self.symbol_table[label]}")
-                    else:
-                        input_post_first_pass.append((instruction_count, removed_comments))
-                        instruction_count += 1
-
-        # print(self.symbol_table)
-        # print(input_post_first_pass)
-
-        next_available_address = self.isa.starting_variable_allocation_address
-
-        for instruction in input_post_first_pass:
-            out_bv = BitVector(size=0)
-            if instruction[1].startswith('@'):
-                # print(f"A instruction: {instruction[1]}")
-                instruction_format = self.isa.opcode_format['a_inst']
-                value = instruction[1].split('@')[1]
-                if value.isdigit():
-                    value = int(value)
-                else:
-                    if value in self.symbol_table:
-                        value = self.symbol_table[value]
-                    else:
-                        # assign next available RAM address to this symbol
-                        self.symbol_table[value] = next_available_address
-                        next_available_address += 1
-                        value = self.symbol_table[value]
-                # print(f"A'{value}'")
-                for entry in instruction_format:
-                    if 'opcode' in entry[0]:
-                        out_bv += self.isa.opcode_map['A'][0]
-                    elif 'value' in entry[0]:
-                        out_bv += BitVector(intVal=value, size=entry[1])
+                yield line
+
+    def first_pass(self, lines):
+        # adds each label to the symbol table at the address of the instruction following it, yields the instructions
+        instruction_count = 0
+        for line in self.strip_comments(lines):
+            if line.startswith('('):
+                label = line.split('(')[1].split(')')[0].strip()
+                # print(f"Label {label} detected at line {instruction_count + 1}")
+                if label not in self.symbol_table:
+                    self.symbol_table[label] = instruction_count
+            else:
+                yield line
+                instruction_count += 1
+
+    def second_pass(self, instructions, start=0):
+        # variables are allocated RAM addresses in order of first use, start numbers the instructions in errors
+        self.next_available_address = self.isa.starting_variable_allocation_address
+        for idx, instruction in enumerate(instructions, start):
+            yield self.encode(instruction, idx)
+
+    def encode(self, instruction, idx=0):
+        word = c_instruction_words.get(instruction)
+        if word is not None:
+            return word
+        if instruction.startswith('@') and instruction[1:2] and (instruction[1:].isdigit() or not instruction[1].isdigit()):
+            # a constant, or a symbol, which can't start with a digit
+            value = instruction[1:]
+            if value.isdigit():
+                value = int(value)
+            elif value in self.symbol_table:
+                value = self.symbol_table[value]
             else:
-                # print(f"C instruction: {instruction[1]}")
-                instruction_format = self.isa.opcode_format['c_inst']
-                inst_eq_split = instruction[1].split('=')
-                if '=' not in instruction[1]:
-                    inst_semi_split = instruction[1].split(';')
-                    dest = 'null'
-                else:
-                    inst_semi_split = inst_eq_split[1].split(';')
-                    dest = inst_eq_split[0]
-                comp = inst_semi_split[0]
-                if len(inst_semi_split) > 1:
-                    jump = inst_semi_split[1]
-                else:
-                    jump = 'null'
-                # print(f"D'{dest}''{comp}''{jump}'")
-                for entry in instruction_format:
-                    if 'opcode' in entry[0]:
-                        out_bv += self.isa.opcode_map['C'][0]
-                    elif 'comp' in entry[0]:
-                        out_bv += self.isa.comp_map[comp]
-                    elif 'dest' in entry[0]:
-                        out_bv += self.isa.dest_map[dest]
-                    elif 'jump' in entry[0]:
-                        out_bv += self.isa.jump_map[jump]
-
-            output_bitlines.append(out_bv)
-
-        error = False
-        for idx, entry in enumerate(output_bitlines):
-            if len(output_bitlines[idx]) != self.isa.word_size:
-                hack_log.fatal(f"unrecognized or erroneous syntax in instruction {idx}: {output_bitlines[idx]}")
-                error = True
-            self.output.append(entry)
-        if error:
-            self.output = []
+                # assign next available RAM address to this symbol
+                self.symbol_table[value] = self.next_available_address
+                value = self.next_available_address
+                self.next_available_address += 1
+            if value <= 0x7FFF:
+                return self.a_opcode | value
+        raise ValueError(f"unrecognized or erroneous syntax in instruction {idx}: {instruction}")
+
+
+class HackAssemblerTests(unittest.TestCase):
+    @staticmethod
+    def assemble(lines):
+        asb = HackAssembler()
+        asb.input = lines
+        asb.parse_assembly()
+        return asb
+
+    @staticmethod
+    def read_output(path):
+        if path.endswith('.hack'):
+            with open(path) as fp:
+                return [int(line, 2) for line in fp.read().split()]
+        return read_words(path).tolist()
+
+    def test_encoding(self):
+        asb = self.assemble(['DM=A+D;JNE', 'MD=D+A;JNE', 'AMD=M|D', 'DAM=D|M', 'D;JMP', '@32767', '@x', '@y', '@x'])
+        self.assertEqual(array('H', [0xE09D, 0xE09D, 0xF578, 0xF578, 0xE307, 0x7FFF, 16, 17, 16]), asb.output)
+
+    def test_bad_instruction(self):
+        for instruction in ('@32768', 'D=D+2', 'D=Q', 'X=A', 'D;JMQ', 'M=D+M;', '@', '@1x'):
+            with self.assertRaises(ValueError):
+                HackAssembler().encode(instruction)
+            with self.assertLogs('hack', 'CRITICAL'):
+                self.assertEqual(array('H'), self.assemble(['@1', instruction, 'D=A']).output)
+
+    def test_stream_assembly(self):
+        lines = ['// sum', '@i', 'M=1 // i = 1', '(LOOP)', '  @i', 'D=M', '@END', 'D;JGT', '@n', 'M=D+M', '@LOOP',
+                 '0;JMP', '(END)', '@END', '0;JMP']
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'sum.asm'), 'w') as fp:
+                fp.write('\n'.join(lines))
+            for name, output_format in (('sum.hack', 'text'), ('sum.img', 'raw')):
+                count = HackAssembler().stream_assembly(os.path.join(directory, 'sum.asm'),
+                                                        os.path.join(directory, name), output_format)
+                self.assertEqual(12, count)
+                self.assertEqual(self.assemble(lines).output.tolist(), self.read_output(os.path.join(directory, name)))
+
+    def test_stream_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bad.asm')
+            with open(path, 'w') as fp:
+                fp.write('@1\nD=A\nD=Q\n')
+            with self.assertLogs('hack', 'CRITICAL'):
+                self.assertIsNone(HackAssembler().stream_assembly(path, os.path.join(directory, 'bad.hack')))
+            # neither the output nor the partial file it was written to is left behind
+            self.assertEqual(['bad.asm'], os.listdir(directory))
+            self.assertIsNone(HackAssembler().stream_assembly(os.path.join(directory, 'missing.asm'), path))
+            self.assertEqual((path, 0, "nothing assembled, see the log for the reason"),
+                             assemble_file(HackAssembler, path, os.path.join(directory, 'bad.hack'), stream=True))
+
+    def test_parallel_assembly(self):
+        # labels defined twice and over a predefined symbol, variables first used in different chunks
+        lines = ['@x', 'M=0', '(LOOP)', '@y', 'D=M // y', '(SP)', '@LOOP', '0;JMP']
+        for i in range(40):
+            lines += [f'(L{i % 7})', f'@v{(i * 5) % 11}', 'D=M', f'@L{(i + 3) % 7}', 'D;JGT', f'@{i}', '@LOOP', '']
+        lines += ['(END)', '@END', '0;JMP', '@y', '@SP\r', '\r', '(R)\r@R\r\n', '@R\f', '@a\v@b']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'big.asm')
+            with open(path, 'w') as fp:
+                fp.write('\n'.join(lines))
+            for chunk_count in (1, 3, 16, 200):
+                asb = HackAssembler()
+                asb.parallel_assembly(path, workers=2, chunk_count=chunk_count)
+                # the serial path reads the file in text mode, with universal newlines
+                serial = HackAssembler()
+                serial.input_assembly(path)
+                self.assertEqual(serial.output, asb.output)
+                self.assertEqual(serial.symbol_table, asb.symbol_table)
+            with open(path, 'a') as fp:
+                fp.write('\n@1\nD=Q\n@2')
+            with self.assertLogs('hack', 'CRITICAL') as logs:
+                self.assertEqual(array('H'), HackAssembler().parallel_assembly(path, workers=2, chunk_count=16))
+            # the index of the bad instruction in the whole file, not in its chunk
+            self.assertIn(f"instruction {len(serial.output) + 1}: D=Q", logs.output[0])
+
+    def test_assemble_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jobs = []
+            for name, lines in (('a', ['@1', 'D=A']), ('bad', ['D=D+2']), ('missing', None), ('c', ['@x', 'M=0'])):
+                if lines is not None:
+                    with open(os.path.join(directory, f'{name}.asm'), 'w') as fp:
+                        fp.write('\n'.join(lines))
+                jobs.append((os.path.join(directory, f'{name}.asm'), os.path.join(directory, f'{name}.hack')))
+            results = assemble_files(HackAssembler, jobs, workers=2)
+            self.assertEqual([job[0] for job in jobs], [result[0] for result in results])
+            self.assertEqual([2, 0, 0, 2], [result[1] for result in results])
+            self.assertEqual([False, True, True, False], [result[2] is not None for result in results])
+            self.assertEqual([16, 0xEA88], self.read_output(os.path.join(directory, 'c.hack')))
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
     parser.add_argument('asm_file', metavar='xxx.hack', type=str, nargs='?', help='assembly file to convert')
+    parser.add_argument('--format', '-f', action='store', choices=output_extensions, default='text', help="binary output format")
+    parser.add_argument('--stream', '-s', action='store_true', help="assemble in bounded memory, for very large files")
+    parser.add_argument('--parallel', '-p', action='store_true', help="split one large file across worker processes")
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=os.cpu_count(), help="worker processes for 'all' and --parallel")
     args = parser.parse_args()
+    extension = output_extensions[args.format]
 
     if args.asm_file:
         if args.asm_file == 'all':
-            for file in os.listdir(os.getcwd()):
-                if file.endswith('.asm'):
-                    print(file)
-                    asb = HackAssembler()
-                    asb.input_assembly(file)
-                    asb.output_binary(file.replace('.asm', '.hack'))
+            files = sorted(file for file in os.listdir(os.getcwd()) if file.endswith('.asm'))
+            jobs = [(file, file.replace('.asm', extension)) for file in files]
+            for file, words, error in assemble_files(HackAssembler, jobs, args.format, args.jobs, args.stream):
+                print(f"{file}: {error}" if error else f"{file}: {words} words")
+        elif args.parallel:
+            asb = HackAssembler()
+            asb.parallel_assembly(args.asm_file, args.jobs)
+            asb.output_binary(args.asm_file.replace('.asm', extension), args.format)
+        elif args.stream:
+            asb = HackAssembler()
+            asb.stream_assembly(args.asm_file, args.asm_file.replace('.asm', extension), args.format)
         else:
             asb = HackAssembler()
             asb.input_assembly(args.asm_file)
-            asb.output_binary(args.asm_file.replace('.asm', '.hack'))
+            asb.output_binary(args.asm_file.replace('.asm', extension), args.format)
     else:
         asb = HackAssembler()
         asb.input_assembly('sample.asm')
-        asb.output_binary('sample.hack')
+        asb.output_binary('sample' + extension, args.format)
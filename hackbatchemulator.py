@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import logging
+import sys
+import unittest
+
+import numpy as np
+
+import hack
+from hackemulator import HackEmulator, RAM_SIZE, JUMP_LT, JUMP_EQ, JUMP_GT
+hack_log = logging.getLogger('hack')
+
+
+class HackBatchEmulator(HackEmulator):
+    """
+    Runs one program across many lanes in lockstep, each lane with its own A, D, PC and RAM held as numpy arrays.
+    Every step executes one instruction in every running lane.  While all lanes share a PC that instruction is a
+    single vectorized operation; lanes whose PC diverges are regrouped by PC and each group is stepped on its own.
+    """
+    def __init__(self, lanes=1):
+        super(HackBatchEmulator, self).__init__(fuse=False)
+        self.lanes = lanes
+        self.lane_index = np.arange(lanes)
+        self.ram = np.zeros((lanes, RAM_SIZE), dtype=np.uint16)
+        self.reset()
+
+    def reset(self):
+        super(HackBatchEmulator, self).reset()
+        self.a = np.zeros(self.lanes, dtype=np.int32)
+        self.d = np.zeros(self.lanes, dtype=np.int32)
+        self.pc = np.zeros(self.lanes, dtype=np.int32)
+        self.cycles = np.zeros(self.lanes, dtype=np.int64)
+        self.halted = np.zeros(self.lanes, dtype=bool)
+        self.faulted = np.zeros(self.lanes, dtype=bool)
+
+    def step_group(self, pc, lanes):
+        # lanes is slice(None) when every lane is at pc, otherwise an index array
+        kind, f, uses_m, dest_a, dest_d, dest_m, jump = self.decoded[pc]
+        if not kind:
+            self.a[lanes] = f
+            self.pc[lanes] = pc + 1
+            return
+        rows = self.lane_index if isinstance(lanes, slice) else lanes
+        a = self.a[lanes]
+        out = f(self.d[lanes], self.ram[rows, a]) if uses_m else f(self.d[lanes], a)
+        if dest_m:
+            self.ram[rows, a] = out
+        if dest_d:
+            self.d[lanes] = out
+        if jump:
+            out = np.broadcast_to(out, a.shape)
+            negative = out >= 0x8000
+            zero = out == 0
+            taken = np.zeros(a.shape, dtype=bool)
+            if jump & JUMP_LT:
+                taken |= negative
+            if jump & JUMP_EQ:
+                taken |= zero
+            if jump & JUMP_GT:
+                taken |= ~negative & ~zero
+            self.pc[lanes] = np.where(taken, a, pc + 1)
+            if pc in self.halt_addresses:
+                halting = taken & (a == pc - 1)
+                self.halted[rows[halting]] = True
+        else:
+            self.pc[lanes] = pc + 1
+        if dest_a:
+            self.a[lanes] = out
+
+    def step_group_checked(self, pc, lanes):
+        try:
+            self.step_group(pc, lanes)
+        except IndexError:
+            # retire the lanes addressing outside RAM and retry the rest, nothing has been written yet
+            rows = self.lane_index if isinstance(lanes, slice) else lanes
+            bad = self.a[rows] >= RAM_SIZE
+            hack_log.error(f"memory access out of range at ROM[{pc}] in lanes {rows[bad].tolist()}")
+            self.halted[rows[bad]] = True
+            self.faulted[rows[bad]] = True
+            self.cycles[rows[bad]] -= 1
+            if (~bad).any():
+                self.step_group(pc, rows[~bad])
+
+    def run(self, max_cycles=None):
+        limit = sys.maxsize if max_cycles is None else max_cycles
+        steps = 0
+        while steps < limit:
+            # ran off the end of the program
+            self.halted |= self.pc >= self.program_size
+            if self.halted.all():
+                break
+            if self.halted.any():
+                active = np.flatnonzero(~self.halted)
+            else:
+                active = slice(None)
+            pcs = self.pc[active]
+            self.cycles[active] += 1
+            if (pcs == pcs[0]).all():
+                self.step_group_checked(int(pcs[0]), active)
+            else:
+                rows = self.lane_index[active]
+                order = np.argsort(pcs, kind='stable')
+                sorted_pcs = pcs[order]
+                starts = np.flatnonzero(np.diff(sorted_pcs)) + 1
+                for group in np.split(order, starts):
+                    self.step_group_checked(int(pcs[group[0]]), rows[group])
+            steps += 1
+        return steps
+
+    def dump_state(self, lane=0, ram_range=range(16)):
+        r = f"cycles: {self.cycles[lane]}\nhalted: {self.halted[lane]}\n"
+        r += f"A: {self.a[lane]}\nD: {self.d[lane]}\nPC: {self.pc[lane]}\n"
+        for address in ram_range:
+            r += f"RAM[{address}]: {self.ram[lane, address]}\n"
+        return r
+
+    def __str__(self):
+        return f"lanes: {self.lanes}\nhalted: {int(self.halted.sum())}\n" + self.dump_state()
+
+
+class HackBatchEmulatorTests(unittest.TestCase):
+    def assert_lanes_match(self, lines, ram_zero, max_cycles=None):
+        asb = hack.HackAssemblerTests.assemble(lines)
+        batch = HackBatchEmulator(lanes=len(ram_zero))
+        batch.load_assembler(asb)
+        batch.ram[:, 0] = ram_zero
+        batch.run(max_cycles)
+        for lane, value in enumerate(ram_zero):
+            emu = HackEmulator()
+            emu.load_assembler(asb)
+            emu.ram[0] = value
+            emu.run(max_cycles)
+            self.assertEqual(emu.dump_state(), batch.dump_state(lane))
+
+    def test_divergent_loops(self):
+        # RAM[1] = sum(1..RAM[0]), every lane runs a different number of iterations
+        lines = [
+            '@i', 'M=1', '@R1', 'M=0',
+            '(LOOP)', '@i', 'D=M', '@R0', 'D=D-M', '@END', 'D;JGT',
+            '@i', 'D=M', '@R1', 'M=D+M', '@i', 'M=M+1', '@LOOP', '0;JMP',
+            '(END)', '@END', '0;JMP',
+        ]
+        self.assert_lanes_match(lines, [0, 1, 5, 17, 100, 3, 3])
+        self.assert_lanes_match(lines, [0, 1, 5, 17, 100, 3, 3], max_cycles=60)
+
+    def test_alu_and_memory_fault(self):
+        lines = ['@R0', 'D=M', 'D=!D', 'D=-D', 'A=D-1', 'M=D', 'D=D|A', '@R1', 'M=D', 'AM=M+1']
+        self.assert_lanes_match(lines, [0, 1, 0x7FFF, 0x8000, 0xFFFF, 32766])
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import tempfile
+import unittest
+
+import hack
+from hack import HackAssembler
+from hackemulator import HackEmulator, RAM_SIZE, WORD_MASK
+hack_log = logging.getLogger('hack')
+
+# rom hash -> (blocks, block sources), shared by every emulator running the same program
+translation_cache = {}
+
+# bumped whenever the generated code changes, so stale cache files aren't loaded
+BLOCK_FORMAT = 2
+
+
+class BlockFault(Exception):
+    # raised by a block about to access RAM out of range, args are (a, d, pc, instructions executed in the block)
+    pass
+
+# python conditions on the 16 bit comp output for each jump code (j1 j2 j3 = lt eq gt)
+jump_conditions = {
+    0b001: '0 < out < 0x8000',
+    0b010: 'out == 0',
+    0b011: 'out < 0x8000',
+    0b100: 'out >= 0x8000',
+    0b101: 'out != 0',
+    0b110: 'out == 0 or out >= 0x8000',
+    0b111: 'True',
+}
+
+
+class HackBlockEmulator(HackEmulator):
+    """
+    Runs the ROM as basic blocks: straight-line code up to and including the next C-instruction with a jump.
+    Each block is translated once into a python function (a, d, ram) -> (a, d, pc), so executing a block costs one
+    call.  Blocks are translated lazily the first time the PC lands on their start address, are shared in memory
+    between emulators running the same ROM, and are optionally persisted to cache_dir keyed by a hash of the ROM.
+    """
+    def __init__(self, cache_dir=None):
+        super(HackBlockEmulator, self).__init__()
+        self.cache_dir = cache_dir
+        self.rom_hash = None
+        self.blocks = {}
+        self.block_sources = {}
+        self.comp_mnemonics = {int(bv): mnemonic for mnemonic, bv in self.isa.comp_map.items()}
+        self.dest_mnemonics = {int(bv): mnemonic for mnemonic, bv in self.isa.dest_map.items()}
+        self.translated = 0
+
+    def load_program(self, program):
+        super(HackBlockEmulator, self).load_program(program)
+        key = self.rom[:self.program_size].tobytes() + f"{sys.implementation.cache_tag}/{BLOCK_FORMAT}".encode()
+        self.rom_hash = hashlib.sha256(key).hexdigest()
+        if self.rom_hash not in translation_cache:
+            translation_cache[self.rom_hash] = ({}, {})
+        self.blocks, self.block_sources = translation_cache[self.rom_hash]
+        if not self.blocks:
+            self.load_block_cache()
+        self.translated = 0
+
+    def cache_path(self):
+        return os.path.join(self.cache_dir, f"{self.rom_hash}.blocks")
+
+    def load_block_cache(self):
+        if self.cache_dir and os.path.exists(self.cache_path()):
+            hack_log.info(f"loading translated blocks from {self.cache_path()}")
+            with open(self.cache_path(), 'rb') as cp:
+                sources, code = marshal.load(cp)
+            namespace = {'BlockFault': BlockFault}
+            exec(code, namespace)
+            self.block_sources.update(sources)
+            self.blocks.update(namespace['blocks'])
+
+    def save_block_cache(self):
+        if self.cache_dir and self.translated:
+            hack_log.info(f"writing {len(self.blocks)} translated blocks to {self.cache_path()}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            code = compile(self.module_source(), self.cache_path(), 'exec')
+            temporary_path = self.cache_path() + '.tmp'
+            with open(temporary_path, 'wb') as cp:
+                marshal.dump((dict(self.block_sources), code), cp)
+            os.replace(temporary_path, self.cache_path())
+            self.translated = 0
+
+    def module_source(self):
+        source = '\n'.join(self.block_sources[start][0] for start in sorted(self.block_sources))
+        table = ', '.join(f"{start}: (block_{start}, {length})" for start, (_, length) in sorted(self.block_sources.items()))
+        return f"{source}\nblocks = {{{table}}}\n"
+
+    def comp_expression(self, mnemonic, a):
+        # returns a python expression for the comp, or an int when it is constant
+        if 'D' not in mnemonic and 'M' not in mnemonic and ('A' not in mnemonic or a != 'a'):
+            return eval(mnemonic.replace('!', '~').replace('A', a)) & WORD_MASK
+        if mnemonic in ('D', 'A', 'M'):
+            return {'D': 'd', 'A': a, 'M': f'ram[{a}]'}[mnemonic]
+        expression = ''
+        for character in mnemonic.replace('!', '~'):
+            expression += {'D': 'd', 'A': a, 'M': f'ram[{a}]'}.get(character, character)
+        return f"({expression}) & {WORD_MASK}"
+
+    def translate_block(self, start):
+        lines = []
+        a = None  # value of A when it is known at translation time, the variable a is stale while it is set
+        address = start
+        exit_line = None
+        while address < self.program_size:
+            word = self.rom[address]
+            address += 1
+            if not word & 0x8000:
+                a = word
+                continue
+            a_expression = 'a' if a is None else str(a)
+            comp = self.comp_mnemonics[(word >> 6) & 0x7F]
+            dest = self.dest_mnemonics[(word >> 3) & 0x7]
+            if 'M' in comp or 'M' in dest:
+                # fault with the state the interpreter stops in: at this instruction, earlier RAM writes done
+                fault = f"raise BlockFault({a_expression}, d, {address - 1}, {address - 1 - start})"
+                if a is None:
+                    lines.extend([f"if a >= {RAM_SIZE}:", f"    {fault}"])
+                elif a >= RAM_SIZE:
+                    lines.append(fault)
+            out = self.comp_expression(comp, a_expression)
+            jump = word & 0x7
+            writes = [register for register in 'MDA' if register in dest]
+            if isinstance(out, str) and (len(writes) > 1 or (jump and writes)):
+                lines.append(f"out = {out}")
+                out = 'out'
+            # M is addressed, and the jump target taken, from A before this instruction writes it
+            if 'M' in dest:
+                lines.append(f"ram[{a_expression}] = {out}")
+            if 'D' in dest:
+                lines.append(f"d = {out}")
+            if jump:
+                if isinstance(out, int):
+                    condition = 'True' if jump & (0b100 if out & 0x8000 else 0b010 if out == 0 else 0b001) else None
+                else:
+                    if out != 'out':
+                        lines.append(f"out = {out}")
+                    condition = jump_conditions[jump]
+                target = a_expression
+                if address - 1 in self.halt_addresses and a == address - 2:
+                    # the (END) @END 0;JMP loop, report the halt with a negative pc
+                    target = f"~{a_expression}"
+            if 'A' in dest:
+                if isinstance(out, int):
+                    a = out
+                else:
+                    if jump and a is None:
+                        lines.append("target = a")
+                        target = 'target'
+                    lines.append(f"a = {out}")
+                    a = None
+            if jump:
+                a_final = 'a' if a is None else str(a)
+                if condition == 'True':
+                    exit_line = [f"return {a_final}, d, {target}"]
+                elif condition is None:
+                    exit_line = [f"return {a_final}, d, {address}"]
+                else:
+                    exit_line = [f"if {condition}:", f"    return {a_final}, d, {target}", f"return {a_final}, d, {address}"]
+                break
+        if exit_line is None:
+            # fell off the end of the program
+            exit_line = [f"return {'a' if a is None else a}, d, {address}"]
+        lines.extend(exit_line)
+        length = address - start
+        source = f"def block_{start}(a, d, ram):\n" + ''.join(f"    {line}\n" for line in lines)
+        namespace = {'BlockFault': BlockFault}
+        exec(source, namespace)
+        self.block_sources[start] = (source, length)
+        self.blocks[start] = (namespace[f'block_{start}'], length)
+        self.translated += 1
+        return self.blocks[start]
+
+    def run(self, max_cycles=None):
+        blocks = self.blocks
+        ram = self.ram
+        program_size = self.program_size
+        a, d, pc = self.a, self.d, self.pc
+        limit = sys.maxsize if max_cycles is None else max_cycles
+        executed = 0
+        if self.halted:
+            return 0
+        while True:
+            entry = blocks.get(pc)
+            if entry is None:
+                if pc >= program_size:
+                    # ran off the end of the program, noticed on the next cycle like the interpreter does
+                    self.halted = executed < limit
+                    break
+                entry = self.translate_block(pc)
+            function, length = entry
+            if executed + length > limit:
+                break
+            try:
+                a, d, pc = function(a, d, ram)
+            except BlockFault as fault:
+                a, d, pc, done = fault.args
+                executed += done
+                self.halted = True
+                hack_log.error(f"memory access out of range at ROM[{pc}]: A={a}")
+                break
+            executed += length
+            if pc < 0:
+                pc = ~pc
+                self.halted = True
+                break
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        if not self.halted and executed < limit and max_cycles is not None:
+            # the remaining budget ends inside a block, finish instruction by instruction
+            executed += super(HackBlockEmulator, self).run(limit - executed)
+        self.save_block_cache()
+        return executed
+
+
+class HackBlockEmulatorTests(unittest.TestCase):
+    programs = [
+        ['@2', 'D=A', '@3', 'D=D+A', '@0', 'M=D'],
+        ['@i', 'M=1', '@R1', 'M=0',
+         '(LOOP)', '@i', 'D=M', '@R0', 'D=D-M', '@END', 'D;JGT',
+         '@i', 'D=M', '@R1', 'M=D+M', '@i', 'M=M+1', '@LOOP', '0;JMP',
+         '(END)', '@END', '0;JMP'],
+        ['@5', 'D=-A', '@R0', 'M=D', 'AM=M+1', 'D=!A', '@R1', 'AM=D;JNE', 'D=0', '@7', 'A=D+A;JMP'],
+    ]
+
+    def assert_matches_interpreter(self, lines, max_cycles=10000):
+        asb = hack.HackAssemblerTests.assemble(lines)
+        reference = HackEmulator()
+        reference.load_assembler(asb)
+        reference.ram[0] = 10
+        reference.run(max_cycles)
+        emu = HackBlockEmulator()
+        emu.load_assembler(asb)
+        emu.ram[0] = 10
+        emu.run(max_cycles)
+        self.assertEqual(reference.dump_state(), emu.dump_state())
+        self.assertEqual(reference.ram, emu.ram)
+
+    def test_matches_interpreter(self):
+        for lines in self.programs:
+            self.assert_matches_interpreter(lines)
+
+    def test_cycle_budget(self):
+        for max_cycles in range(12):
+            for lines in self.programs:
+                self.assert_matches_interpreter(lines, max_cycles)
+
+    def test_memory_fault(self):
+        # RAM writes, then an access through a computed address past the end of RAM, inside one block
+        lines = ['@R2', 'M=1', '@R0', 'D=M', '@32767', 'D=D+A', '@R3', 'M=D', 'A=D', 'M=M+1', '@R4', 'M=1']
+        self.assert_matches_interpreter(lines)
+        self.assert_matches_interpreter(['@R2', 'M=1', 'A=-1', 'D=M', '@R4', 'M=1'])
+
+    def test_block_cache(self):
+        asb = hack.HackAssemblerTests.assemble(self.programs[1])
+        # translations are shared process wide, start from none and leave none behind
+        translation_cache.clear()
+        self.addCleanup(translation_cache.clear)
+        with tempfile.TemporaryDirectory() as directory:
+            emu = HackBlockEmulator(cache_dir=directory)
+            emu.load_assembler(asb)
+            emu.ram[0] = 3
+            emu.run(10)
+            path = emu.cache_path()
+            written = os.stat(path).st_mtime_ns
+            os.utime(path, ns=(0, 0))
+            # nothing newly translated, so the cache file isn't written again
+            emu.step()
+            self.assertEqual(0, os.stat(path).st_mtime_ns)
+            emu.run()
+            self.assertNotEqual(0, os.stat(path).st_mtime_ns)
+            self.assertGreater(written, 0)
+            translation_cache.clear()
+            cached = HackBlockEmulator(cache_dir=directory)
+            cached.load_assembler(asb)
+            self.assertEqual(len(emu.blocks), len(cached.blocks))
+            cached.ram[0] = 3
+            cached.run()
+            self.assertEqual(6, cached.ram[1])
+            self.assertEqual(0, cached.translated)
+
+    def test_block_translated_once(self):
+        asb = hack.HackAssemblerTests.assemble(self.programs[1])
+        emu = HackBlockEmulator()
+        emu.load_assembler(asb)
+        emu.ram[0] = 100
+        emu.run()
+        self.assertEqual(5050, emu.ram[1])
+        self.assertTrue(emu.halted)
+        self.assertEqual(4, len(emu.blocks))
+        second = HackBlockEmulator()
+        second.load_assembler(asb)
+        self.assertIs(emu.blocks, second.blocks)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('program', metavar='xxx.asm|xxx.hack', type=str, help='assembly or binary file to run')
+    parser.add_argument('--cycles', '-n', action='store', type=int, default=None, help="maximum number of cycles to run")
+    parser.add_argument('--cache', action='store', default=None, help="directory to cache translated blocks in")
+    args = parser.parse_args()
+
+    emu = HackBlockEmulator(cache_dir=args.cache)
+    if args.program.endswith('.asm'):
+        asb = HackAssembler()
+        asb.input_assembly(args.program)
+        emu.load_assembler(asb)
+    else:
+        emu.input_binary(args.program)
+    emu.run(args.cycles)
+    print(emu)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+from array import array
+
+import hack
+from emulator import Emulator
+from hack import Hack, HackAssembler
+from memory import map_words, write_words
+hack_log = logging.getLogger('hack')
+
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+WORD_MASK = 0xFFFF
+
+# jump bits j1 j2 j3 select on out < 0, out == 0, out > 0
+JUMP_LT = 0b100
+JUMP_EQ = 0b010
+JUMP_GT = 0b001
+
+# decoded entry kinds
+A_INSTRUCTION = 0
+C_INSTRUCTION = 1
+FUSED = 2
+
+
+# superinstructions for the fixed idioms VMTranslator emits, SP lives in RAM[0].  One raises IndexError before it
+# writes anything, so execute can replay a faulting sequence instruction by instruction.
+def pop_d(a, d, ram):
+    # @SP AM=M-1 D=M
+    sp = (ram[0] - 1) & WORD_MASK
+    if sp >= RAM_SIZE:
+        raise IndexError(sp)
+    ram[0] = sp
+    return sp, ram[sp]
+
+
+def push_d(a, d, ram):
+    # @SP A=M M=D @SP M=M+1
+    ram[ram[0]] = d
+    ram[0] = (ram[0] + 1) & WORD_MASK
+    return 0, d
+
+
+def decrement_sp_load_a(a, d, ram):
+    # @SP M=M-1 A=M
+    a = ram[0] = (ram[0] - 1) & WORD_MASK
+    return a, d
+
+
+def increment_sp(a, d, ram):
+    # @SP M=M+1
+    ram[0] = (ram[0] + 1) & WORD_MASK
+    return 0, d
+
+
+fused_sequences = [
+    (('@SP', 'A=M', 'M=D', '@SP', 'M=M+1'), push_d),
+    (('@SP', 'AM=M-1', 'D=M'), pop_d),
+    (('@SP', 'M=M-1', 'A=M'), decrement_sp_load_a),
+    (('@SP', 'M=M+1'), increment_sp),
+]
+# (encoded words, function) for each fused sequence, assembled on first use
+fused_words = []
+
+
+class HackEmulator(Emulator):
+    def __init__(self, fuse=True):
+        super(HackEmulator, self).__init__(Hack())
+        self.rom = array('H', bytes(2 * ROM_SIZE))
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.program_size = 0
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.comp_functions = {}
+        self.dest_flags = {}
+        self.jump_codes = set()
+        self.decoded = []
+        self.plain_decoded = []
+        self.halt_addresses = set()
+        self.fuse = fuse
+        self.build_tables()
+
+    def build_tables(self):
+        # comp mnemonics are valid python once '!' becomes '~', so each one compiles to a 2 operand function
+        for mnemonic, bv in self.isa.comp_map.items():
+            operand = 'M' if 'M' in mnemonic else 'A'
+            function = eval(f"lambda D, {operand}: ({mnemonic.replace('!', '~')}) & {WORD_MASK}")
+            self.comp_functions[int(bv)] = (function, operand == 'M')
+        for mnemonic, bv in self.isa.dest_map.items():
+            self.dest_flags[int(bv)] = ('A' in mnemonic, 'D' in mnemonic, 'M' in mnemonic)
+        for bv in self.isa.jump_map.values():
+            self.jump_codes.add(int(bv))
+        if self.fuse and not fused_words:
+            for sequence, function in fused_sequences:
+                asb = HackAssembler()
+                asb.input = list(sequence)
+                asb.parse_assembly()
+                fused_words.append((tuple(int(bv) for bv in asb.output), function))
+
+    def decode(self, word):
+        # returns (kind, function or a-value, uses_m, dest_a, dest_d, dest_m, jump)
+        if not word & 0x8000:
+            return A_INSTRUCTION, word, False, False, False, False, 0
+        comp = (word >> 6) & 0x7F
+        dest = (word >> 3) & 0x7
+        jump = word & 0x7
+        if comp not in self.comp_functions or jump not in self.jump_codes:
+            return None
+        function, uses_m = self.comp_functions[comp]
+        dest_a, dest_d, dest_m = self.dest_flags[dest]
+        return C_INSTRUCTION, function, uses_m, dest_a, dest_d, dest_m, jump
+
+    def load_program(self, program):
+        if isinstance(program, memoryview):
+            # a mapped image (Emulator.input_image) is decoded and used as the ROM in place, without a copy
+            words = program
+        else:
+            words = program.tolist() if isinstance(program, array) else [int(word) for word in program]
+        if len(words) > ROM_SIZE:
+            hack_log.fatal(f"program of {len(words)} words does not fit in {ROM_SIZE} words of ROM")
+            return
+        decode_cache = {}
+        decoded = []
+        for address, word in enumerate(words):
+            if word not in decode_cache:
+                decode_cache[word] = self.decode(word)
+            if decode_cache[word] is None:
+                hack_log.fatal(f"unrecognized instruction at ROM[{address}]: {word:016b}")
+                return
+            decoded.append(decode_cache[word])
+        if isinstance(words, memoryview):
+            self.rom = words
+        else:
+            self.rom = array('H', bytes(2 * ROM_SIZE))
+            self.rom[:len(words)] = array('H', words)
+        self.program_size = len(words)
+        self.plain_decoded = decoded
+        self.decoded = self.fuse_sequences(words, decoded)
+        self.find_halt_addresses()
+        self.reset()
+
+    def fuse_sequences(self, words, decoded):
+        # only the first address of a sequence is replaced, so jumping into the middle still runs the plain entries
+        fused = list(decoded)
+        if not self.fuse:
+            return fused
+        for address in range(len(words)):
+            for sequence, function in fused_words:
+                if tuple(words[address:address + len(sequence)]) == sequence:
+                    # (FUSED, function, sequence length, ...)
+                    fused[address] = (FUSED, function, len(sequence), False, False, False, 0)
+                    break
+        return fused
+
+    def find_halt_addresses(self):
+        # the conventional end of a hack program is the tight loop (END) @END 0;JMP
+        self.halt_addresses = set()
+        unconditional = self.decode(
+            (int(self.isa.opcode_map['C'][0]) << 13) | (int(self.isa.comp_map['0']) << 6) |
+            (int(self.isa.dest_map['null']) << 3) | int(self.isa.jump_map['JMP']))
+        for address in range(1, self.program_size):
+            if self.plain_decoded[address] == unconditional and self.rom[address - 1] == address - 1:
+                self.halt_addresses.add(address)
+
+    def map_ram(self, path):
+        # RAM backed by a file, its contents survive the emulator and reset() leaves them alone like the array's
+        self.ram = map_words(path, RAM_SIZE, writable=True)
+
+    def reset(self):
+        super(HackEmulator, self).reset()
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+
+    def run(self, max_cycles=None):
+        if self.halted:
+            return 0
+        limit = sys.maxsize if max_cycles is None else max_cycles
+        executed = self.execute(self.decoded, limit)
+        if executed < limit and not self.halted:
+            # the budget ends inside a fused sequence, finish instruction by instruction
+            executed += self.execute(self.plain_decoded, limit - executed)
+        return executed
+
+    def execute(self, decoded, limit):
+        ram = self.ram
+        halt_addresses = self.halt_addresses
+        a, d, pc = self.a, self.d, self.pc
+        executed = 0
+        try:
+            while executed < limit:
+                kind, f, uses_m, dest_a, dest_d, dest_m, jump = decoded[pc]
+                executed += 1
+                if not kind:
+                    a = f
+                    pc += 1
+                    continue
+                if kind == FUSED:
+                    # uses_m holds the sequence length
+                    if executed + uses_m - 1 > limit:
+                        executed -= 1
+                        break
+                    a, d = f(a, d, ram)
+                    executed += uses_m - 1
+                    pc += uses_m
+                    continue
+                out = f(d, ram[a]) if uses_m else f(d, a)
+                if dest_m:
+                    ram[a] = out
+                if dest_d:
+                    d = out
+                if jump and jump & (JUMP_LT if out & 0x8000 else JUMP_EQ if out == 0 else JUMP_GT):
+                    if pc in halt_addresses and a == pc - 1:
+                        self.halted = True
+                        pc = a
+                        break
+                    pc = a
+                else:
+                    pc += 1
+                if dest_a:
+                    a = out
+        except IndexError:
+            if pc >= len(decoded):
+                # ran off the end of the program
+                self.halted = True
+            elif decoded[pc][0] == FUSED:
+                # nothing is written yet, the plain entries fault where the program does
+                executed -= 1
+                self.a, self.d, self.pc = a, d, pc
+                self.cycles += executed
+                return executed + self.execute(self.plain_decoded, decoded[pc][2])
+            else:
+                executed -= 1
+                self.halted = True
+                hack_log.error(f"memory access out of range at ROM[{pc}]: A={a}")
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        return executed
+
+    def step(self):
+        return self.run(1)
+
+    def dump_state(self, ram_range=range(16)):
+        r = f"cycles: {self.cycles}\nhalted: {self.halted}\n"
+        r += f"A: {self.a}\nD: {self.d}\nPC: {self.pc}\n"
+        for address in ram_range:
+            r += f"RAM[{address}]: {self.ram[address]}\n"
+        return r
+
+
+class HackEmulatorTests(unittest.TestCase):
+    def test_add(self):
+        emu = HackEmulator()
+        emu.load_assembler(hack.HackAssemblerTests.assemble(['@2', 'D=A', '@3', 'D=D+A', '@0', 'M=D']))
+        self.assertEqual(6, emu.run())
+        self.assertTrue(emu.halted)
+        self.assertEqual(5, emu.ram[0])
+
+    def test_loop_and_halt(self):
+        # RAM[1] = sum(1..RAM[0])
+        emu = HackEmulator()
+        emu.load_assembler(hack.HackAssemblerTests.assemble([
+            '@i', 'M=1', '@R1', 'M=0',
+            '(LOOP)', '@i', 'D=M', '@R0', 'D=D-M', '@END', 'D;JGT',
+            '@i', 'D=M', '@R1', 'M=D+M', '@i', 'M=M+1', '@LOOP', '0;JMP',
+            '(END)', '@END', '0;JMP',
+        ]))
+        emu.ram[0] = 100
+        emu.run(max_cycles=100000)
+        self.assertTrue(emu.halted)
+        self.assertEqual(5050, emu.ram[1])
+        self.assertEqual(18, emu.pc)
+
+    def test_negative_and_cycle_budget(self):
+        emu = HackEmulator()
+        emu.load_assembler(hack.HackAssemblerTests.assemble(['@5', 'D=-A', '@R0', 'M=D', 'AM=M+1', 'D=!A']))
+        self.assertEqual(3, emu.run(max_cycles=3))
+        self.assertFalse(emu.halted)
+        emu.run()
+        # M is written at the old A
+        self.assertEqual(0xFFFC, emu.ram[0])
+        self.assertEqual(0xFFFC, emu.a)
+        self.assertEqual(3, emu.d)
+
+    def test_fused_sequences(self):
+        # push 7, push 5, pop into D, then jump into the middle of the push idiom at PUSH_D
+        lines = [
+            '@256', 'D=A', '@SP', 'M=D',
+            '@7', 'D=A', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@5', 'D=A', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@SP', 'AM=M-1', 'D=M',
+            '@SP', 'M=M-1', 'A=M', 'D=D+M',
+            '@R1', 'M=M+1', 'D=M', '@3', 'D=D-A', '@DONE', 'D;JGE',
+            '@SP', 'A=M', '@PUSH_D', '0;JMP',
+            '@SP', 'A=M', '(PUSH_D)', 'M=D', '@SP', 'M=M+1', '@SP', 'M=M+1', '@R1', 'D=M', '@18', '0;JMP',
+            '(DONE)', '@DONE', '0;JMP',
+        ]
+        asb = hack.HackAssemblerTests.assemble(lines)
+        for max_cycles in list(range(0, 120, 7)) + [None]:
+            plain = HackEmulator(fuse=False)
+            plain.load_assembler(asb)
+            plain.run(max_cycles)
+            fused = HackEmulator()
+            fused.load_assembler(asb)
+            self.assertIn(FUSED, [entry[0] for entry in fused.decoded])
+            self.assertEqual(plain.run(0), fused.run(0))
+            executed = fused.run(max_cycles)
+            self.assertEqual(plain.cycles, executed)
+            self.assertEqual(plain.dump_state(range(256, 264)), fused.dump_state(range(256, 264)))
+
+    def test_fused_faults(self):
+        # an SP out of range faults at the same instruction and state as the plain entries
+        sequences = [sequence for sequence, function in fused_sequences]
+        for sp in (0, 1, RAM_SIZE - 1, RAM_SIZE, RAM_SIZE + 1, WORD_MASK):
+            for sequence in sequences:
+                set_sp = [f'@{sp}', 'D=A'] if sp < 0x8000 else [f'@{~sp & WORD_MASK}', 'D=!A']
+                lines = set_sp + ['@SP', 'M=D', '@9', 'D=A'] + list(sequence) * 2 + ['(END)', '@END', '0;JMP']
+                asb = hack.HackAssemblerTests.assemble(lines)
+                for max_cycles in (None, 8, 9):
+                    plain = HackEmulator(fuse=False)
+                    plain.load_assembler(asb)
+                    plain.run(max_cycles)
+                    fused = HackEmulator()
+                    fused.load_assembler(asb)
+                    self.assertEqual(plain.cycles, fused.run(max_cycles))
+                    self.assertEqual(plain.dump_state(range(4)), fused.dump_state(range(4)))
+
+    def test_output_formats(self):
+        asb = hack.HackAssemblerTests.assemble(['@R0', 'D=M', '@R1', 'M=D+M', '@32767', 'D=-A'])
+        with tempfile.TemporaryDirectory() as directory:
+            for name, output_format in (('add.hack', 'text'), ('add.img', 'raw'), ('add.hex', 'hex')):
+                asb.output_binary(os.path.join(directory, name), output_format)
+                emu = HackEmulator()
+                emu.input_binary(os.path.join(directory, name))
+                self.assertEqual([int(word) for word in asb.output], emu.rom[:emu.program_size].tolist())
+            self.assertEqual(2 * len(asb.output), os.path.getsize(os.path.join(directory, 'add.img')))
+
+    def test_image_and_mapped_ram(self):
+        # RAM[1] += RAM[0], twice over the same RAM file
+        asb = hack.HackAssemblerTests.assemble(['@R0', 'D=M', '@R1', 'M=D+M'])
+        with tempfile.TemporaryDirectory() as directory:
+            write_words(os.path.join(directory, 'add.img'), asb.output)
+            for total in (7, 14):
+                emu = HackEmulator()
+                emu.input_image(os.path.join(directory, 'add.img'))
+                emu.map_ram(os.path.join(directory, 'ram.img'))
+                # the ROM is the mapped image itself
+                self.assertIsInstance(emu.rom.obj, mmap.mmap)
+                emu.ram[0] = 7
+                emu.run()
+                self.assertTrue(emu.halted)
+                self.assertEqual(total, emu.ram[1])
+                del emu
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('program', metavar='xxx.asm|xxx.hack|xxx.img|xxx.hex', type=str, help='assembly, binary, packed image or Intel HEX file to run')
+    parser.add_argument('--cycles', '-n', action='store', type=int, default=None, help="maximum number of cycles to run")
+    parser.add_argument('--ram', action='store', default=None, help="file to map RAM onto, created if missing")
+    args = parser.parse_args()
+
+    emu = HackEmulator()
+    if args.ram:
+        emu.map_ram(args.ram)
+    if args.program.endswith('.asm'):
+        asb = HackAssembler()
+        asb.input_assembly(args.program)
+        emu.load_assembler(asb)
+    elif args.program.endswith('.img'):
+        emu.input_image(args.program)
+    else:
+        emu.input_binary(args.program)
+    emu.run(args.cycles)
+    print(emu)
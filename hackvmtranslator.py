@@ -2,7 +2,11 @@ import argparse
 import logging
 import os
 import sys
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, auto
+from itertools import repeat
 
 from hack import Hack
 from translator import Translator
@@ -23,6 +27,43 @@ logical_commands = [
     'not',
 ]
 
+# every push ends by storing D on the stack, a static or pointer pop starts by taking the top of the stack into D,
+# and a segment pop ends by moving the top of the stack to the address it computed into D
+push_tail = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1']
+pop_head = ['@SP', 'AM=M-1', 'D=M']
+segment_pop_tail = ['@SP', 'M=M-1', '@R13', 'M=D', '@SP', 'A=M', 'D=M', '@R13', 'A=M', 'M=D']
+
+# binary / unary commands the peephole optimizer rewrites, as the computation applied to the top of the stack
+binary_operations = {
+    'add': ('M=D+M', lambda x, y: x + y),
+    'sub': ('M=M-D', lambda x, y: x - y),
+    'and': ('M=D&M', lambda x, y: x & y),
+    'or': ('M=D|M', lambda x, y: x | y),
+}
+unary_operations = {
+    'neg': ('M=-M', lambda x: -x),
+    'not': ('M=!M', lambda x: ~x),
+}
+
+# labels of the routines shared by every call site in code-size mode
+routine_labels = {
+    'eq': 'VM$EQ',
+    'lt': 'VM$LT',
+    'gt': 'VM$GT',
+    'call': 'VM$CALL',
+    'return': 'VM$RETURN',
+    'end': 'VM$END',
+}
+comparison_jumps = {'eq': 'JEQ', 'lt': 'JLT', 'gt': 'JGT'}
+
+# adjacent instructions at the same address that collapse into fewer
+instruction_pairs = {
+    ('M=M+1', 'M=M-1'): [],
+    ('M=M-1', 'M=M+1'): [],
+    ('M=M+1', 'AM=M-1'): ['A=M'],
+    ('M=M-1', 'A=M'): ['AM=M-1'],
+}
+
 
 class Command(Enum):
     ARITHMETIC = auto()
@@ -43,11 +84,18 @@ class VMTranslator(Translator):
         self.branch_id = 0
         self.return_id = 0
         self.current_file = ''
+        self.current_function = ''
+        self.optimize = False
+        # code-size mode, comparisons, call and return jump to one shared copy emitted after the bootstrap, or after
+        # the program when there's no bootstrap.  Files joined after a bootstrap that has them leave them out.
+        self.shared_routines = False
+        self.include_routines = True
         self.output = []
 
     def parse_vm(self, write_init=False):
         hack_log.info('translating the hack vm input to hack assembly')
         self.current_file = os.path.splitext(os.path.basename(self.input_path))[0]
+        start = len(self.output)
         if write_init:
             self.output.extend(self.write_init())
         for line in self.input:
@@ -82,10 +130,24 @@ class VMTranslator(Translator):
                         self.output.extend(self.write_return())
                     elif command_type == Command.CALL:
                         self.output.extend(self.write_call(label, num_vars))
+        if self.shared_routines and self.include_routines and not write_init:
+            # without a bootstrap the program runs off its last command, so halt it before the routines
+            self.output.extend(['// end', f"({routine_labels['end']})", f"@{routine_labels['end']}", '0;JMP'])
+            self.output.extend(self.write_routines())
+        if self.optimize:
+            self.output[start:] = peephole(self.output[start:])
 
     def set_file_name(self, file_name):
         self.current_file = file_name
 
+    def file_label(self, label):
+        # labels the translator generates are prefixed with the file name, so files translated apart never collide
+        return f"{self.current_file}.{label}" if self.current_file else label
+
+    def function_label(self, label):
+        # vm labels are scoped to the function they appear in
+        return f"{self.current_function}${label}" if self.current_function else label
+
     @staticmethod
     def decode_command(line):
         sp_line = line.split()
@@ -119,33 +181,72 @@ class VMTranslator(Translator):
             # 'D=D-1', '@THAT', 'M=D',
         ]
         assembly.extend(self.write_call('Sys.init', '0'))
+        if self.shared_routines and self.include_routines:
+            assembly.extend(self.write_routines())
         return assembly
 
     @staticmethod
-    def write_label(label):
-        return [f"({label})"]
+    def write_routines():
+        """
+        The routines call sites jump to in code-size mode.  A comparison or call site passes its return address in
+        D, a call site also the function address in R14 and the number of arguments in R13.
+        """
+        assembly = []
+        for command, jump in comparison_jumps.items():
+            routine = routine_labels[command]
+            assembly.extend([
+                f'// {command} routine',
+                f'({routine})', '@R15', 'M=D',
+                # # D = x - y, *(SP-1) = true
+                '@SP', 'AM=M-1', 'D=M', 'A=A-1', 'D=M-D', 'M=-1',
+                # # *(SP-1) = false unless the comparison holds
+                f'@{routine}$TRUE', f'D;{jump}', '@SP', 'A=M-1', 'M=0',
+                f'({routine}$TRUE)', '@R15', 'A=M', '0;JMP',
+            ])
+        assembly.extend([
+            '// call routine',
+            f"({routine_labels['call']})",
+            # # push return address, LCL, ARG, THIS, THAT
+            '@SP', 'A=M', 'M=D',
+            '@LCL', 'D=M', '@SP', 'AM=M+1', 'M=D',
+            '@ARG', 'D=M', '@SP', 'AM=M+1', 'M=D',
+            '@THIS', 'D=M', '@SP', 'AM=M+1', 'M=D',
+            '@THAT', 'D=M', '@SP', 'AM=M+1', 'M=D',
+            # # LCL = SP
+            '@SP', 'MD=M+1', '@LCL', 'M=D',
+            # # ARG = SP - 5 - number_of_arguments
+            '@5', 'D=D-A', '@R13', 'D=D-M', '@ARG', 'M=D',
+            # # goto function
+            '@R14', 'A=M', '0;JMP',
+            '// return routine',
+            f"({routine_labels['return']})",
+        ])
+        assembly.extend(VMTranslator.write_frame_return())
+        return assembly
 
-    @staticmethod
-    def write_goto(label):
+    def write_label(self, label):
+        return [f"({self.function_label(label)})"]
+
+    def write_goto(self, label):
         return [
             f'// goto {label}',
-            f'@{label}', '0;JMP'
+            f'@{self.function_label(label)}', '0;JMP'
         ]
 
-    @staticmethod
-    def write_if_goto(label):
+    def write_if_goto(self, label):
         return [
             f'// if-goto {label}',
             # D = *(SP--)
             '@SP', 'AM=M-1', 'D=M',
             # if D: goto label  (D < 0 -> (D=-1 true)
-            f'@{label}', 'D;JLT',
+            f'@{self.function_label(label)}', 'D;JLT',
         ]
 
     def write_function(self, function_name, number_of_variables):
         # # initialize local variables
         # set LCL to SP
         # for num of vars, push 0 to stack
+        self.current_function = function_name
         assembly = [
             f'// function {function_name} {number_of_variables}',
             f'({function_name})', '@SP', 'D=M', '@LCL', 'M=D'
@@ -155,8 +256,16 @@ class VMTranslator(Translator):
         return assembly
 
     def write_call(self, function_name, number_of_arguments):
-        return_address_label = f"{function_name}$ret.{self.return_id}"
+        return_address_label = self.file_label(f"{function_name}$ret.{self.return_id}")
         self.return_id += 1
+        if self.shared_routines:
+            return [
+                f'// call {function_name} {number_of_arguments}',
+                f'@{number_of_arguments}', 'D=A', '@R13', 'M=D',
+                f'@{function_name}', 'D=A', '@R14', 'M=D',
+                f'@{return_address_label}', 'D=A', f"@{routine_labels['call']}", '0;JMP',
+                f'({return_address_label})'
+            ]
         return [
             f'// call {function_name} {number_of_arguments}',
             # # push return_address_label
@@ -179,10 +288,14 @@ class VMTranslator(Translator):
             f'({return_address_label})'
         ]
 
+    def write_return(self):
+        if self.shared_routines:
+            return ['// return', f"@{routine_labels['return']}", '0;JMP']
+        return ['// return'] + self.write_frame_return()
+
     @staticmethod
-    def write_return():
+    def write_frame_return():
         return [
-            '// return',
             # # endFrame = LCL
             '@LCL', 'D=M', '@R13', 'M=D',
             # # returnAddr = *(endFrame - 5)
@@ -206,6 +319,14 @@ class VMTranslator(Translator):
     def write_arithmetic(self, command):
         # TODO: optionally print comments
         assembly = [f'// {command}']
+        label = self.file_label('')
+        if self.shared_routines and command in comparison_jumps:
+            return_label = f'{label}END_{command.upper()}_{self.branch_id}'
+            self.branch_id += 1
+            return assembly + [
+                f'@{return_label}', 'D=A', f'@{routine_labels[command]}', '0;JMP',
+                f'({return_label})'
+            ]
         if command == 'add':
             assembly.extend([
                 # # pop y
@@ -309,13 +430,13 @@ class VMTranslator(Translator):
                 # SP--
                 '@SP', 'M=M-1',
                 # if D==0 JNE -> (not_equal)
-                'A=M', 'D=D-M', f'@NOT_EQ_{self.branch_id}', 'D;JNE',
+                'A=M', 'D=D-M', f'@{label}NOT_EQ_{self.branch_id}', 'D;JNE',
                 # *(SP) = -1
-                '@SP', 'A=M', 'M=-1', f'@END_EQ_{self.branch_id}', '0;JMP',
+                '@SP', 'A=M', 'M=-1', f'@{label}END_EQ_{self.branch_id}', '0;JMP',
                 #(not_equal) *SP = 0
-                f'(NOT_EQ_{self.branch_id})', '@SP', 'A=M', 'M=0',
+                f'({label}NOT_EQ_{self.branch_id})', '@SP', 'A=M', 'M=0',
                 #(end_equal) SP++
-                f'(END_EQ_{self.branch_id})', '@SP', 'M=M+1'
+                f'({label}END_EQ_{self.branch_id})', '@SP', 'M=M+1'
             ])
             self.branch_id += 1
 
@@ -330,13 +451,13 @@ class VMTranslator(Translator):
                 # SP--
                 '@SP', 'M=M-1',
                 # if D < 0 JLE -> (not_lt)
-                'A=M', 'D=D-M', f'@NOT_LT_{self.branch_id}', 'D;JLE',
+                'A=M', 'D=D-M', f'@{label}NOT_LT_{self.branch_id}', 'D;JLE',
                 # *(SP) = -1
-                '@SP', 'A=M', 'M=-1', f'@END_LT_{self.branch_id}', '0;JMP',
+                '@SP', 'A=M', 'M=-1', f'@{label}END_LT_{self.branch_id}', '0;JMP',
                 # (not_lt) *SP = 0
-                f'(NOT_LT_{self.branch_id})', '@SP', 'A=M', 'M=0',
+                f'({label}NOT_LT_{self.branch_id})', '@SP', 'A=M', 'M=0',
                 # (end_lt) SP++
-                f'(END_LT_{self.branch_id})', '@SP', 'M=M+1'
+                f'({label}END_LT_{self.branch_id})', '@SP', 'M=M+1'
             ])
             self.branch_id += 1
 
@@ -351,13 +472,13 @@ class VMTranslator(Translator):
                 # SP--
                 '@SP', 'M=M-1',
                 # if D > 0 JGE -> (not_gt)
-                'A=M', 'D=D-M', f'@NOT_GT_{self.branch_id}', 'D;JGE',
+                'A=M', 'D=D-M', f'@{label}NOT_GT_{self.branch_id}', 'D;JGE',
                 # *(SP) = -1
-                '@SP', 'A=M', 'M=-1', f'@END_GT_{self.branch_id}', '0;JMP',
+                '@SP', 'A=M', 'M=-1', f'@{label}END_GT_{self.branch_id}', '0;JMP',
                 # (not_gt) *SP = 0
-                f'(NOT_GT_{self.branch_id})', '@SP', 'A=M', 'M=0',
+                f'({label}NOT_GT_{self.branch_id})', '@SP', 'A=M', 'M=0',
                 # (end_gt) SP++
-                f'(END_GT_{self.branch_id})', '@SP', 'M=M+1'
+                f'({label}END_GT_{self.branch_id})', '@SP', 'M=M+1'
             ])
             self.branch_id += 1
 
@@ -461,27 +582,408 @@ class VMTranslator(Translator):
         return assembly
 
 
+def constant_load(value):
+    # D = any 16 bit value, in as few instructions as possible
+    value &= 0xFFFF
+    if value in (0, 1):
+        return [f'D={value}']
+    if value == 0xFFFF:
+        return ['D=-1']
+    if value <= 0x7FFF:
+        return [f'@{value}', 'D=A']
+    return [f'@{~value & 0xFFFF}', 'D=!A']
+
+
+def split_blocks(assembly):
+    """
+    Splits translator output into blocks of (comments, vm command, instructions), one per vm command, using the
+    comment each write_* method starts with.  A label starts a block of its own with no command, so no rewrite
+    ever moves code across a jump target.
+    """
+    blocks = []
+    for line in assembly:
+        if line.startswith('//'):
+            blocks.append(([line], tuple(line[2:].split()), []))
+        elif line.startswith('(') or not blocks:
+            blocks.append(([], None, [line]))
+        else:
+            blocks[-1][2].append(line)
+    return blocks
+
+
+def push_load(block):
+    # the instructions of a push block that leave the pushed value in D, or None
+    comments, command, lines = block
+    if command and command[0] == 'push' and lines[-len(push_tail):] == push_tail:
+        return lines[:-len(push_tail)]
+    return None
+
+
+def pop_parts(block):
+    """
+    Splits a pop block into the instructions that set up the destination, leaving D free, and the ones that store D
+    there, so the popped value can come from anywhere in between.  None if the block isn't a pop.
+    """
+    comments, command, lines = block
+    if not command or command[0] != 'pop':
+        return None
+    if lines[:len(pop_head)] == pop_head:
+        return [], lines[len(pop_head):]
+    if lines[-len(segment_pop_tail):] == segment_pop_tail:
+        # the address is kept in R13 while D carries the value
+        return lines[:-len(segment_pop_tail)] + ['@R13', 'M=D'], ['@R13', 'A=M', 'M=D']
+    return None
+
+
+def pushed_constant(block):
+    comments, command, lines = block
+    if command and command[:2] == ('push', 'constant') and push_load(block) is not None:
+        return int(command[2])
+    return None
+
+
+def fold_block(blocks):
+    """
+    Tries to rewrite the newest blocks in place, returns True if it did:
+        push constant x, push constant y, binary -> push constant (x op y)
+        push constant x, unary -> push constant (op x)
+        push x, binary -> D = x, op into the top of the stack
+        push x, pop y -> D = x stored straight to y
+        binary, unary or segment pop on their own -> work on the top of the stack without moving SP twice
+    """
+    comments, command, lines = blocks[-1]
+    operation = command[0] if command and len(command) == 1 else None
+    if len(blocks) > 2 and operation in binary_operations:
+        x, y = pushed_constant(blocks[-3]), pushed_constant(blocks[-2])
+        if x is not None and y is not None:
+            value = binary_operations[operation][1](x, y) & 0xFFFF
+            merged = blocks[-3][0] + blocks[-2][0] + comments
+            blocks[-3:] = [(merged, ('push', 'constant', str(value)), constant_load(value) + push_tail)]
+            return True
+    if len(blocks) > 1 and operation in unary_operations:
+        x = pushed_constant(blocks[-2])
+        if x is not None:
+            value = unary_operations[operation][1](x) & 0xFFFF
+            merged = blocks[-2][0] + comments
+            blocks[-2:] = [(merged, ('push', 'constant', str(value)), constant_load(value) + push_tail)]
+            return True
+    load = push_load(blocks[-2]) if len(blocks) > 1 else None
+    if load is not None and operation in binary_operations:
+        merged = blocks[-2][0] + comments
+        if pushed_constant(blocks[-2]) == 0 and operation in ('add', 'sub', 'or'):
+            folded = []
+        elif pushed_constant(blocks[-2]) == 1 and operation in ('add', 'sub'):
+            folded = ['@SP', 'A=M-1', 'M=M+1' if operation == 'add' else 'M=M-1']
+        else:
+            folded = load + ['@SP', 'A=M-1', binary_operations[operation][0]]
+        blocks[-2:] = [(merged, None, folded)]
+        return True
+    parts = pop_parts(blocks[-1])
+    if load is not None and parts is not None:
+        # the pop's address setup only touches R13, so the pushed value can be loaded after it
+        setup, store = parts
+        blocks[-2:] = [(blocks[-2][0] + comments, None, setup + load + store)]
+        return True
+    if parts is not None and parts[0]:
+        # a segment pop on its own, set up the address before popping rather than moving SP twice
+        setup, store = parts
+        blocks[-1] = (comments, None, setup + pop_head + store)
+        return True
+    if operation in binary_operations and lines:
+        blocks[-1] = (comments, None, pop_head + ['A=A-1', binary_operations[operation][0]])
+        return True
+    if operation in unary_operations and lines:
+        blocks[-1] = (comments, None, ['@SP', 'A=M-1', unary_operations[operation][0]])
+        return True
+    return False
+
+
+def fold_instructions(assembly):
+    """
+    Drops A-loads of the address A already holds and collapses adjacent instruction pairs, in straight line code;
+    labels forget what A holds.
+    """
+    result = []
+    # indices in result of the instructions since the last label, comments aren't instructions
+    instructions = []
+    address = None
+    for line in assembly:
+        if line.startswith('//'):
+            result.append(line)
+            continue
+        if line.startswith('('):
+            address = None
+            instructions = []
+            result.append(line)
+            continue
+        if line.startswith('@'):
+            if line[1:] == address:
+                continue
+            address = line[1:]
+        elif instructions and (result[instructions[-1]], line) in instruction_pairs:
+            replacement = instruction_pairs[result[instructions[-1]], line]
+            if replacement:
+                result[instructions[-1]] = replacement[0]
+                address = None if 'A' in replacement[0].split('=')[0] else address
+            else:
+                # only comments follow the last instruction, so no other index moves
+                del result[instructions.pop()]
+            continue
+        elif 'A' in line.split('=')[0] and '=' in line:
+            address = None
+        instructions.append(len(result))
+        result.append(line)
+    return result
+
+
+def peephole(assembly):
+    """
+    Optimizes translator output: folds constant arithmetic, turns a push followed by a pop into a move, operates on
+    the top of the stack in place rather than popping and pushing it, and removes redundant A-loads and stack
+    pointer updates.  The result computes the same values in every live location; dead stack slots above SP may
+    hold different garbage.
+    """
+    blocks = []
+    for block in split_blocks(assembly):
+        blocks.append(block)
+        while fold_block(blocks):
+            pass
+    return fold_instructions([line for comments, command, lines in blocks for line in comments + lines])
+
+
+def translate_file(path, optimize=False, shared_routines=False):
+    # runs in a worker process, returns the file's assembly lines
+    vmt = VMTranslator()
+    vmt.optimize = optimize
+    vmt.shared_routines = shared_routines
+    # the bootstrap translate_directory puts first carries the routines
+    vmt.include_routines = False
+    vmt.input_vm(path)
+    return vmt.output
+
+
+def translate_directory(directory, output_path=None, workers=None, optimize=False, shared_routines=False):
+    """
+    Translates every .vm file in directory across a process pool into one assembly file, the bootstrap first and then
+    each file in name order.  Generated labels are scoped to their file, so the result doesn't depend on which files
+    were translated together.  Returns the assembly lines.
+    """
+    files = sorted(file for file in os.listdir(directory) if file.endswith('.vm'))
+    paths = [os.path.join(directory, file) for file in files if os.path.isfile(os.path.join(directory, file))]
+    vmt = VMTranslator()
+    vmt.shared_routines = shared_routines
+    assembly = vmt.write_init()
+    if optimize:
+        assembly = peephole(assembly)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for lines in executor.map(translate_file, paths, repeat(optimize), repeat(shared_routines)):
+            assembly.extend(lines)
+    if output_path:
+        hack_log.info(f"writing assembly to file: {os.path.abspath(output_path)}")
+        with open(output_path, 'w') as op:
+            op.writelines(f"{line}\n" for line in assembly)
+    return assembly
+
+
+class VMTranslatorTests(unittest.TestCase):
+    # both files use eq and a label called LOOP, and call into each other
+    sources = {
+        'Sys.vm': [
+            'function Sys.init 0',
+            'push constant 3', 'push constant 3', 'eq',
+            'call Main.twice 1',
+            'pop static 0',
+            'label LOOP', 'goto LOOP',
+        ],
+        'Main.vm': [
+            'function Main.twice 0',
+            'push argument 0', 'push argument 0', 'add',
+            'push constant 5', 'push constant 5', 'eq',
+            'label LOOP',
+            'if-goto SKIP',
+            'push constant 100', 'add',
+            'label SKIP',
+            'return',
+        ],
+    }
+
+    def test_translate_directory(self):
+        from hack import HackAssembler
+        from hackemulator import HackEmulator
+        with tempfile.TemporaryDirectory() as directory:
+            for name, lines in self.sources.items():
+                with open(os.path.join(directory, name), 'w') as fp:
+                    fp.write('\n'.join(lines))
+            assembly = translate_directory(directory, os.path.join(directory, 'Test.asm'), workers=2)
+            with open(os.path.join(directory, 'Test.asm')) as fp:
+                self.assertEqual(assembly, fp.read().split('\n')[:-1])
+        self.assertEqual('// Bootstrap', assembly[0])
+        self.assertIn('(Main.NOT_EQ_0)', assembly)
+        self.assertIn('(Sys.NOT_EQ_0)', assembly)
+        self.assertIn('(Sys.Main.twice$ret.0)', assembly)
+        self.assertIn('(Main.twice$LOOP)', assembly)
+        asb = HackAssembler()
+        asb.input = assembly
+        asb.parse_assembly()
+        emu = HackEmulator()
+        emu.load_assembler(asb)
+        emu.run(10000)
+        self.assertTrue(emu.halted)
+        # twice(3 == 3) is -2, stored in the first static
+        self.assertEqual(0xFFFE, emu.ram[asb.symbol_table['Sys.0']])
+
+    def test_shared_routines_without_bootstrap(self):
+        from hack import HackAssembler
+        from hackemulator import HackEmulator
+        lines = ['push constant 3', 'push constant 3', 'eq', 'push constant 2', 'push constant 3', 'gt', 'pop static 1',
+                 'pop static 0', 'label END', 'goto END']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'Test.vm')
+            with open(path, 'w') as fp:
+                fp.write('\n'.join(lines))
+            vmt = VMTranslator()
+            vmt.shared_routines = True
+            vmt.input_vm(path)
+            # one copy of each routine, also when translated with the others of a directory
+            self.assertEqual(1, vmt.output.count('(VM$EQ)'))
+            self.assertEqual(1, translate_directory(directory, shared_routines=True, workers=1).count('(VM$EQ)'))
+        asb = HackAssembler()
+        asb.input = vmt.output
+        asb.parse_assembly()
+        # every routine is defined as a label, rather than allocated as a variable
+        self.assertLess(asb.symbol_table['VM$EQ'], len(asb.output))
+        self.assertLess(asb.symbol_table['VM$GT'], len(asb.output))
+        emu = HackEmulator()
+        emu.load_assembler(asb)
+        emu.ram[0] = 256
+        emu.run(1000)
+        self.assertTrue(emu.halted)
+        self.assertEqual([0xFFFF, 0], [emu.ram[asb.symbol_table['Test.0']], emu.ram[asb.symbol_table['Test.1']]])
+        # a program that doesn't loop at its end halts rather than running into the routines
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'Test.vm')
+            with open(path, 'w') as fp:
+                fp.write('\n'.join(['push constant 7', 'push constant 8', 'add']))
+            vmt = VMTranslator()
+            vmt.shared_routines = True
+            vmt.input_vm(path)
+        asb = HackAssembler()
+        asb.input = vmt.output
+        asb.parse_assembly()
+        emu = HackEmulator()
+        emu.load_assembler(asb)
+        emu.ram[0] = 256
+        emu.run(1000)
+        self.assertTrue(emu.halted)
+        self.assertEqual([257, 15], [emu.ram[0], emu.ram[256]])
+
+    def run_translated(self, lines, optimize=False, shared_routines=False):
+        from hack import HackAssembler
+        from hackemulator import HackEmulator
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'Sys.vm')
+            with open(path, 'w') as fp:
+                fp.write('\n'.join(lines))
+            vmt = VMTranslator()
+            vmt.optimize = optimize
+            vmt.shared_routines = shared_routines
+            vmt.input_vm(path, write_init=True)
+        asb = HackAssembler()
+        asb.input = vmt.output
+        asb.parse_assembly()
+        emu = HackEmulator()
+        emu.load_assembler(asb)
+        emu.run(100000)
+        self.assertTrue(emu.halted)
+        return emu, len(asb.output)
+
+    def test_peephole(self):
+        lines = [
+            'function Sys.init 3',
+            'push constant 3000', 'pop pointer 0', 'push constant 4000', 'pop pointer 1',
+            # constant folding, including results only reachable through D=!A
+            'push constant 7', 'push constant 5', 'sub', 'push constant 2', 'neg', 'add', 'pop local 0',
+            'push constant 30000', 'push constant 30000', 'add', 'pop static 0',
+            'push constant 1', 'neg', 'not', 'push constant 12', 'or', 'pop static 1',
+            # push then op, push then pop across every segment
+            'push constant 100', 'push local 0', 'add', 'pop this 2',
+            'push this 2', 'pop that 5', 'push that 5', 'pop temp 3', 'push temp 3', 'pop argument 0',
+            'push static 0', 'push constant 1', 'add', 'push constant 0', 'sub', 'pop local 2',
+            'push pointer 1', 'push pointer 0', 'sub', 'neg', 'pop static 2',
+            # ops on computed values, comparisons, a loop counting local 1 up to 5
+            'label LOOP', 'push local 1', 'push constant 1', 'add', 'pop local 1',
+            'push local 1', 'push constant 5', 'lt', 'if-goto LOOP',
+            'push local 1', 'push local 0', 'push this 2', 'add', 'and', 'not', 'pop static 3',
+            'push local 1', 'push static 3', 'eq', 'push local 1', 'push constant 5', 'gt', 'or', 'pop static 4',
+            'push constant 3', 'call Main.twice 1', 'pop static 5',
+            'label END', 'goto END',
+            'function Main.twice 0', 'push argument 0', 'push argument 0', 'add', 'return',
+        ]
+        plain, plain_size = self.run_translated(lines)
+        optimized, optimized_size = self.run_translated(lines, optimize=True)
+        self.assert_same_live_state(plain, optimized)
+        self.assertEqual([60000, 12, -1000 & 0xFFFF, 0xFFFF & ~(5 & 100), 0, 6], plain.ram[16:22].tolist())
+        self.assertLess(optimized_size, plain_size * 2 // 3)
+        self.assertLess(optimized.cycles, plain.cycles)
+
+    def assert_same_live_state(self, expected, emu):
+        # R13-R15 are scratch and slots above SP dead, so only the rest has to match, and RAM[256] holds the
+        # bootstrap's return address, which moves with the code
+        live = list(range(0, 13)) + list(range(16, 24)) + list(range(3000, 3010)) + list(range(4000, 4010))
+        self.assertEqual([expected.ram[i] for i in live], [emu.ram[i] for i in live])
+        self.assertEqual(list(expected.ram[257:expected.ram[0]]), list(emu.ram[257:emu.ram[0]]))
+
+    def test_shared_routines(self):
+        lines = [
+            'function Sys.init 1',
+            'push constant 3', 'push constant 4', 'call Math.compare 2', 'pop static 0',
+            'push constant 4', 'push constant 3', 'call Math.compare 2', 'pop static 1',
+            'push constant 5', 'push constant 5', 'call Math.compare 2', 'pop static 2',
+            'push constant 6', 'call Math.sum 1', 'pop static 3',
+            'label END', 'goto END',
+            # x < y -> 1, x > y -> 2, x == y -> 4, set in local 0 bit by bit
+            'function Math.compare 1',
+            'push argument 0', 'push argument 1', 'lt', 'push constant 1', 'and',
+            'push argument 0', 'push argument 1', 'gt', 'push constant 2', 'and', 'or',
+            'push argument 0', 'push argument 1', 'eq', 'push constant 4', 'and', 'or',
+            'pop local 0', 'push local 0', 'return',
+            # recursive, n + sum(n - 1)
+            'function Math.sum 0',
+            'push argument 0', 'push constant 0', 'eq', 'if-goto BASE',
+            'push argument 0', 'push argument 0', 'push constant 1', 'sub', 'call Math.sum 1', 'add', 'return',
+            'label BASE', 'push constant 0', 'return',
+        ]
+        plain, plain_size = self.run_translated(lines)
+        self.assertEqual([1, 2, 4, 21], plain.ram[16:20].tolist())
+        for optimize in (False, True):
+            shared, shared_size = self.run_translated(lines, optimize=optimize, shared_routines=True)
+            self.assert_same_live_state(plain, shared)
+            self.assertLess(shared_size, plain_size * 3 // 4)
+
+    def test_fold_instructions(self):
+        self.assertEqual(['@SP', 'A=M'], fold_instructions(['@SP', 'M=M+1', '@SP', 'AM=M-1']))
+        self.assertEqual(['@SP', '// x', 'D=M'], fold_instructions(['@SP', 'M=M+1', '// x', '@SP', 'M=M-1', 'D=M']))
+        self.assertEqual(['@SP', 'AM=M-1', '@SP'], fold_instructions(['@SP', 'M=M-1', 'A=M', '@SP']))
+        # a label is a jump target, A isn't known there
+        self.assertEqual(['@SP', 'M=M+1', '(L)', '@SP', 'M=M-1'], fold_instructions(['@SP', 'M=M+1', '(L)', '@SP', 'M=M-1']))
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
     parser.add_argument('vm_src', metavar='xxx.vm', type=str, nargs='?', help='vm file / directory to convert')
+    parser.add_argument('--optimize', '-O', action='store_true', help="run the peephole optimizer over the output")
+    parser.add_argument('--compact', '-c', action='store_true', help="share one copy of the comparison, call and return code")
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=os.cpu_count(), help="worker processes for a directory")
     args = parser.parse_args()
 
     if args.vm_src:
         if os.path.isfile(args.vm_src) and args.vm_src.endswith('.vm'):
             vmt = VMTranslator()
+            vmt.optimize = args.optimize
+            vmt.shared_routines = args.compact
             vmt.input_vm(args.vm_src)
             vmt.output_assembly(args.vm_src.replace('.vm', '.asm'))
         elif os.path.isdir(args.vm_src):
-            vm_output_assembly = os.path.join(args.vm_src, os.path.basename(args.vm_src) + '.asm')
-            with open(vm_output_assembly, 'w') as oa:
-                vm_file_count = 0
-                for file in os.listdir(args.vm_src):
-                    if os.path.isfile(file) and file.endswith('.vm'):
-                        vmt = VMTranslator()
-                        if vm_file_count == 0:
-                            vmt.input_vm(file, write_init=True)
-                        else:
-                            vmt.input_vm(file)
-                        vmt.output_assembly(vm_output_assembly, oa)
-                        vm_file_count += 1
+            directory = os.path.normpath(args.vm_src)
+            translate_directory(directory, os.path.join(directory, os.path.basename(directory) + '.asm'), args.jobs, args.optimize, args.compact)
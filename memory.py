@@ -0,0 +1,175 @@
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+from array import array
+from itertools import islice
+memory_log = logging.getLogger('memory')
+
+
+def packed_chunks(words, size=4096):
+    # little-endian array('H') chunks of an iterable of ints or BitVectors, so writers never hold the whole image
+    iterator = iter(words)
+    while True:
+        chunk = array('H', map(int, islice(iterator, size)))
+        if not chunk:
+            return
+        if sys.byteorder != 'little':
+            chunk.byteswap()
+        yield chunk
+
+
+def write_words(path, words):
+    # packed image, one little-endian 16 bit word per instruction, words are ints or BitVectors
+    with open(path, 'wb') as fp:
+        for chunk in packed_chunks(words):
+            chunk.tofile(fp)
+
+
+def read_words(path):
+    # packed image read into an array('H'), for when a private copy is wanted rather than a map
+    words = array('H')
+    with open(path, 'rb') as fp:
+        words.frombytes(fp.read())
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+
+def write_intel_hex(path, words, record_size=16):
+    """
+    Intel HEX image of the words, byte addressed with each word little-endian like the packed image.  Extended
+    linear address records are emitted every 64K bytes, so a full 64K word memory fits.
+    """
+    offset = 0
+    with open(path, 'w') as fp:
+        # 64K byte chunks, so records never straddle an extended address boundary
+        for chunk in packed_chunks(words, 0x8000):
+            data = chunk.tobytes()
+            for start in range(0, len(data), record_size):
+                if offset and not offset & 0xFFFF:
+                    fp.write(hex_record(0, 4, (offset >> 16).to_bytes(2, 'big')))
+                record = data[start:start + record_size]
+                fp.write(hex_record(offset & 0xFFFF, 0, record))
+                offset += len(record)
+        fp.write(hex_record(0, 1, b''))
+
+
+def hex_record(address, record_type, data):
+    record = bytes([len(data)]) + address.to_bytes(2, 'big') + bytes([record_type]) + data
+    return f":{record.hex().upper()}{-sum(record) & 0xFF:02X}\n"
+
+
+def read_intel_hex(path):
+    data = bytearray()
+    base = 0
+    with open(path) as fp:
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = bytes.fromhex(line[1:]) if line.startswith(':') else b''
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+                raise ValueError(f"{path}:{number}: malformed or corrupt record")
+            address = int.from_bytes(record[1:3], 'big')
+            record_type = record[3]
+            if record_type == 0:
+                start = base + address
+                if len(data) < start + record[0]:
+                    data.extend(bytes(start + record[0] - len(data)))
+                data[start:start + record[0]] = record[4:-1]
+            elif record_type == 1:
+                break
+            elif record_type == 4:
+                base = int.from_bytes(record[4:6], 'big') << 16
+    words = array('H')
+    words.frombytes(bytes(data[:len(data) & ~1]))
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+
+# file extension -> binary format, anything else is the text format
+binary_formats = {'.img': 'raw', '.hex': 'hex'}
+# and back, the extension assemblers give each binary format
+format_extensions = {output_format: extension for extension, output_format in binary_formats.items()}
+
+
+def map_words(path, size=None, writable=False):
+    """
+    Maps a packed image of little-endian 16 bit words into memory and returns it as a memoryview of unsigned
+    shorts, which indexes and slices like array('H') without reading or copying the file.  Given a size, the file
+    is created or zero-extended to hold that many words.  Writes to a writable map go straight to the file, so RAM
+    mapped this way persists between runs and can be inspected while the machine is stopped.
+    """
+    if size is not None:
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as fp:
+            if os.path.getsize(path) < 2 * size:
+                fp.truncate(2 * size)
+    length = os.path.getsize(path) // 2 if size is None else size
+    if not length:
+        # mmap can't map an empty file
+        return memoryview(array('H'))
+    with open(path, 'r+b' if writable else 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 2 * length, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    if sys.byteorder != 'little':
+        memory_log.warning(f"{path} is little-endian, copying it on this big-endian host, writes won't persist")
+        words = array('H', mapped)
+        words.byteswap()
+        return memoryview(words)
+    return memoryview(mapped).cast('H')
+
+
+def flush(words):
+    # pushes writes to a mapped file out to disk
+    if isinstance(words.obj, mmap.mmap):
+        words.obj.flush()
+
+
+class MemoryTests(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rom.img')
+            write_words(path, [0, 1, 0x8000, 0xFFFF])
+            self.assertEqual(8, os.path.getsize(path))
+            rom = map_words(path)
+            self.assertEqual([0, 1, 0x8000, 0xFFFF], rom.tolist())
+            self.assertTrue(rom.readonly)
+            self.assertEqual(b'\x00\x00\x01\x00\x00\x80\xff\xff', rom.tobytes())
+            write_words(path, [])
+            self.assertEqual(0, len(map_words(path)))
+            del rom
+
+    def test_persistent_ram(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ram.img')
+            ram = map_words(path, 16, writable=True)
+            self.assertEqual([0] * 16, ram.tolist())
+            ram[3] = 1234
+            ram[15] = 0xFFFF
+            flush(ram)
+            del ram
+            self.assertEqual(1234, map_words(path)[3])
+            ram = map_words(path, 32, writable=True)
+            self.assertEqual([0, 0, 0, 1234], ram[:4].tolist())
+            self.assertEqual(0xFFFF, ram[15])
+            self.assertEqual(0, ram[31])
+            del ram
+
+    def test_intel_hex(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rom.hex')
+            write_intel_hex(path, [0x1234, 0xABCD])
+            with open(path) as fp:
+                self.assertEqual([':040000003412CDAB3E', ':00000001FF'], fp.read().split())
+            words = [(i * 7919) & 0xFFFF for i in range(40000)]
+            write_intel_hex(path, words)
+            self.assertEqual(words, read_intel_hex(path).tolist())
+            write_words(os.path.join(directory, 'rom.img'), words)
+            self.assertEqual(words, read_words(os.path.join(directory, 'rom.img')).tolist())
+            with open(path, 'w') as fp:
+                fp.write(':040000003412CDAB3F\n')
+            with self.assertRaises(ValueError):
+                read_intel_hex(path)
@@ -1,5 +1,11 @@
+import argparse
+import os
+import tempfile
+import unittest
+
 from isa import Isa
-from assembler import Assembler
+from assembler import Assembler, assemble_file, assemble_files
+from memory import format_extensions
 import logging
 from BitVector import BitVector
 risc16_log = logging.getLogger('risc16')
@@ -113,12 +119,16 @@ class Risc16Assembler(Assembler):
 
         # pprint(labels)
         idx = 0
+        error = False
         for i in output_bitlines:
             space = 1
             # print(output_bitlines[idx])
-            # label substitution (immediate)
+            # label substitution (immediate), beq targets are relative to the following instruction
             if i[5] in labels:
-                i[5] = labels[i[5]]
+                if i[2] == 'beq':
+                    i[5] = labels[i[5]] - (i[0] + 1)
+                else:
+                    i[5] = labels[i[5]]
             # directive handling
             if i[2] in self.isa.assembler_directives:
                 directive = i[2]
@@ -165,7 +175,18 @@ class Risc16Assembler(Assembler):
                     elif 'reg' in entry[0]:
                         out_bv += BitVector(intVal=int(inst[4].pop(0)), size=entry[1])
                     elif 'imm' in entry[0]:
-                        out_bv += BitVector(intVal=int(inst[5]), size=entry[1])
+                        # signed fields take -2**(n-1) to 2**(n-1)-1, unsigned 0 to 2**n-1
+                        imm = int(inst[5])
+                        if entry[0] == 'immsign':
+                            low, high = -(1 << entry[1] - 1), (1 << entry[1] - 1) - 1
+                        else:
+                            low, high = 0, (1 << entry[1]) - 1
+                        if not low <= imm <= high:
+                            risc16_log.fatal(f"{inst[2]} immediate {imm} out of range [{low}, {high}] "
+                                             f"in instruction {idx}")
+                            error = True
+                        # negative immediates are stored as two's complement in the field width
+                        out_bv += BitVector(intVal=imm % (1 << entry[1]), size=entry[1])
                     elif '0' in entry[0]:
                         out_bv += BitVector(size=entry[1])
                 output_bitlines[idx] = out_bv
@@ -173,7 +194,6 @@ class Risc16Assembler(Assembler):
             # print(output_bitlines[idx])
             idx += space
 
-        error = False
         for idx, entry in enumerate(output_bitlines):
             if len(output_bitlines[idx]) != 16:
                 risc16_log.fatal(f"unrecognized or erroneous syntax in instruction {idx}: {output_bitlines[idx]}")
@@ -182,15 +202,64 @@ class Risc16Assembler(Assembler):
         if error:
             self.output = []
 
+# output format -> suffix added to the source file name, the binary formats use memory's extensions
+output_extensions = {'text': '.bin', **format_extensions}
+
+
+class Risc16AssemblerTests(unittest.TestCase):
+    @staticmethod
+    def assemble(lines):
+        asb = Risc16Assembler()
+        asb.input = lines
+        asb.parse_assembly()
+        return asb
+
+    def test_immediate_bounds(self):
+        asb = self.assemble(['addi 1,1,63', 'addi 1,1,-64', 'sw 1,0,-64', 'lui 1,0', 'lui 1,1023', 'jalr 0,0,63'])
+        self.assertEqual([0x24BF, 0x24C0, 0x8440, 0x6400, 0x67FF, 0xE03F], [int(word) for word in asb.output])
+        for line in ('addi 1,1,64', 'addi 1,1,200', 'lw 1,0,-65', 'lui 1,1024', 'lui 1,2000', 'lui 1,-1'):
+            with self.assertLogs('risc16', 'CRITICAL'):
+                self.assertEqual([], self.assemble(['halt', line]).output)
+        # beq offsets are relative to the next instruction, so 64 forward or 63 back from the beq at most
+        near = ['beq 0,0,far'] + ['nop'] * 63 + ['far: halt']
+        self.assertEqual(65, len(self.assemble(near).output))
+        with self.assertLogs('risc16', 'CRITICAL'):
+            self.assertEqual([], self.assemble(near[:1] + ['nop'] + near[1:]).output)
+        back = ['back: nop'] + ['nop'] * 62 + ['beq 0,0,back']
+        self.assertEqual(64, len(self.assemble(back).output))
+        with self.assertLogs('risc16', 'CRITICAL'):
+            self.assertEqual([], self.assemble(['nop'] + back[:1] + ['nop'] + back[1:]).output)
+
+    def test_no_streaming(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'halt.risc16')
+            with open(path, 'w') as fp:
+                fp.write('halt\n')
+            self.assertIsNone(Risc16Assembler().stream_assembly(path, path + '.bin'))
+            self.assertEqual((path, 0, "nothing assembled, see the log for the reason"),
+                             assemble_file(Risc16Assembler, path, path + '.bin', stream=True))
+            self.assertEqual((path, 1, None), assemble_file(Risc16Assembler, path, path + '.bin'))
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-
-    asb = Risc16Assembler()
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('asm_file', metavar='xxx.risc16', type=str, nargs='?', default='sample.risc16', help="assembly file to convert, or 'all' for every .risc16 file in the current directory")
+    parser.add_argument('--format', '-f', action='store', choices=output_extensions, default='text', help="binary output format")
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=os.cpu_count(), help="worker processes for 'all'")
+    args = parser.parse_args()
+    extension = output_extensions[args.format]
 
     # om = asb.isa.opcode_map
     # for op in om:
     #     print("{} | {:4} | ".format(om[op][0], op))
-    
-    asb.input_assembly('sample.risc16')
-    asb.output_binary('sample.risc16.bin')
+
+    if args.asm_file == 'all':
+        files = sorted(file for file in os.listdir(os.getcwd()) if file.endswith('.risc16'))
+        jobs = [(file, file + extension) for file in files]
+        for file, words, error in assemble_files(Risc16Assembler, jobs, args.format, args.jobs):
+            print(f"{file}: {error}" if error else f"{file}: {words} words")
+    else:
+        asb = Risc16Assembler()
+        asb.input_assembly(args.asm_file)
+        asb.output_binary(args.asm_file + extension, args.format)
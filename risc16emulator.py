@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import tempfile
+import unittest
+import zlib
+from array import array
+
+from emulator import Emulator
+from memory import map_words, write_words
+import risc16
+from risc16 import Risc16, Risc16Assembler
+risc16_log = logging.getLogger('risc16')
+
+MEMORY_SIZE = 65536
+REGISTER_COUNT = 8
+WORD_MASK = 0xFFFF
+
+
+class Halt(Exception):
+    pass
+
+
+class Risc16Emulator(Emulator):
+    def __init__(self):
+        super(Risc16Emulator, self).__init__(Risc16())
+        self.registers = [0] * REGISTER_COUNT
+        self.memory = array('H', bytes(2 * MEMORY_SIZE))
+        self.program_size = 0
+        self.pc = 0
+        self.decoded = []
+        self.decode_cache = {}
+        self.opcode_names = {int(code): name for name, (code, _) in self.isa.opcode_map.items()}
+        self.handlers = {}
+        self.build_handlers()
+
+    def build_handlers(self):
+        # handlers close over the register list, memory and decode table, so those are only ever mutated in place
+        regs = self.registers
+        mem = self.memory
+        decoded = self.decoded
+        emulator = self
+
+        def nop(pc, a, b, c):
+            return pc + 1
+
+        def add(pc, a, b, c):
+            regs[a] = (regs[b] + regs[c]) & WORD_MASK
+            return pc + 1
+
+        def addi(pc, a, b, imm):
+            regs[a] = (regs[b] + imm) & WORD_MASK
+            return pc + 1
+
+        def nand(pc, a, b, c):
+            regs[a] = ~(regs[b] & regs[c]) & WORD_MASK
+            return pc + 1
+
+        def lui(pc, a, b, imm):
+            regs[a] = imm << 6
+            return pc + 1
+
+        def sw(pc, a, b, imm):
+            address = (regs[b] + imm) & WORD_MASK
+            mem[address] = regs[a]
+            if address < len(decoded):
+                # self-modifying code, keep the decode table coherent
+                decoded[address] = emulator.decode(regs[a])
+            return pc + 1
+
+        def lw(pc, a, b, imm):
+            regs[a] = mem[(regs[b] + imm) & WORD_MASK]
+            return pc + 1
+
+        def beq(pc, a, b, imm):
+            if regs[a] == regs[b]:
+                return (pc + 1 + imm) & WORD_MASK
+            return pc + 1
+
+        def jalr(pc, a, b, imm):
+            target = regs[b]
+            regs[a] = pc + 1
+            return target
+
+        def jr(pc, a, b, imm):
+            # jalr with r0 as the link register
+            return regs[b]
+
+        def halt(pc, a, b, imm):
+            raise Halt()
+
+        def syscall(pc, a, b, imm):
+            risc16_log.error(f"unsupported system call {imm} at {pc} treated as halt")
+            raise Halt()
+
+        self.handlers = {
+            'nop': nop,
+            'add': add,
+            'addi': addi,
+            'nand': nand,
+            'lui': lui,
+            'sw': sw,
+            'lw': lw,
+            'beq': beq,
+            'jalr': jalr,
+            'jr': jr,
+            'halt': halt,
+            'syscall': syscall,
+        }
+
+    def decode(self, word):
+        # returns (handler, regA, regB, regC or immediate)
+        if word in self.decode_cache:
+            return self.decode_cache[word]
+        opcode = self.opcode_names[word >> 13]
+        reg_a = (word >> 10) & 0x7
+        reg_b = (word >> 7) & 0x7
+        if self.isa.opcode_map[opcode][1] == 'rrr':
+            imm = word & 0x7
+        elif self.isa.opcode_map[opcode][1] == 'rri':
+            imm = word & 0x7F
+            if imm & 0x40:
+                imm -= 0x80
+        else:
+            imm = word & 0x3FF
+        handler = self.handlers[opcode]
+        if opcode == 'jalr':
+            if imm:
+                # non-zero immediates are system calls, only halt (1) is supported
+                handler = self.handlers['halt'] if imm == 1 else self.handlers['syscall']
+            elif reg_a == 0:
+                handler = self.handlers['jr']
+        elif reg_a == 0 and opcode in ('add', 'addi', 'nand', 'lui', 'lw'):
+            # r0 is hardwired to 0, writes to it are discarded
+            handler = self.handlers['nop']
+        entry = (handler, reg_a, reg_b, imm)
+        self.decode_cache[word] = entry
+        return entry
+
+    def load_program(self, program):
+        words = program.tolist() if isinstance(program, (array, memoryview)) else [int(word) for word in program]
+        if len(words) > MEMORY_SIZE:
+            risc16_log.fatal(f"program of {len(words)} words does not fit in {MEMORY_SIZE} words of memory")
+            return
+        if isinstance(self.memory, array):
+            self.memory[:] = array('H', bytes(2 * MEMORY_SIZE))
+        # mapped memory keeps whatever the file holds past the program, so it persists across loads
+        self.memory[:len(words)] = array('H', words)
+        self.program_size = len(words)
+        self.decode_cache.clear()
+        self.decoded.clear()
+        for word in words:
+            # inline the cache hit path, most programs only use a handful of distinct words
+            entry = self.decode_cache.get(word)
+            if entry is None:
+                if word >> 13 not in self.opcode_names:
+                    risc16_log.fatal(f"unrecognized opcode in word {word:016b}")
+                    return
+                entry = self.decode(word)
+            self.decoded.append(entry)
+        self.reset()
+
+    def map_memory(self, path):
+        # memory backed by a file, whatever the file already holds over the loaded program is run from there on
+        self.memory = map_words(path, MEMORY_SIZE, writable=True)
+        self.decode_cache.clear()
+        self.build_handlers()
+        self.decoded[:] = [self.decode(word) for word in self.memory[:self.program_size]]
+
+    def reset(self):
+        super(Risc16Emulator, self).reset()
+        self.registers[:] = [0] * REGISTER_COUNT
+        self.pc = 0
+
+    def run(self, max_cycles=None):
+        decoded = self.decoded
+        pc = self.pc
+        limit = -1 if max_cycles is None else max_cycles
+        executed = 0
+        if self.halted:
+            return 0
+        try:
+            while executed != limit:
+                handler, a, b, c = decoded[pc]
+                pc = handler(pc, a, b, c)
+                executed += 1
+        except Halt:
+            executed += 1
+            self.halted = True
+        except IndexError:
+            # ran off the end of the program
+            self.halted = True
+        self.pc = pc
+        self.cycles += executed
+        return executed
+
+    def step(self):
+        return self.run(1)
+
+    def checkpoint(self):
+        # architectural state as (cycles, pc, registers, compressed memory), small enough to keep one every few
+        # thousand instructions and to send to another process
+        return self.cycles, self.pc, tuple(self.registers), zlib.compress(self.memory.tobytes(), 1)
+
+    def restore(self, checkpoint):
+        cycles, pc, registers, memory = checkpoint
+        self.memory[:] = array('H', zlib.decompress(memory))
+        # the program may have rewritten itself since it was loaded
+        self.decoded[:] = [self.decode(word) for word in self.memory[:len(self.decoded)]]
+        self.registers[:] = registers
+        self.pc = pc
+        self.cycles = cycles
+        self.halted = False
+
+    def dump_state(self, memory_range=()):
+        r = f"cycles: {self.cycles}\nhalted: {self.halted}\nPC: {self.pc}\n"
+        for index, value in enumerate(self.registers):
+            r += f"r{index}: {value:#06x} ({value - 0x10000 if value & 0x8000 else value})\n"
+        for address in memory_range:
+            r += f"mem[{address}]: {self.memory[address]:#06x}\n"
+        return r
+
+
+class Risc16EmulatorTests(unittest.TestCase):
+    def test_countdown(self):
+        emu = Risc16Emulator()
+        emu.load_assembler(risc16.Risc16AssemblerTests.assemble([
+            '        lw 1,0,count',
+            '        lw r2,1,2',
+            'start:  add 1,1,2',
+            '        beq 0,1,1',
+            '        beq 0,0,start',
+            'done:   halt',
+            'count:  .fill 5',
+            'neg1:   .fill -1',
+        ]))
+        emu.run(max_cycles=1000)
+        self.assertTrue(emu.halted)
+        self.assertEqual(5, emu.pc)
+        self.assertEqual([0, 0, 0xFFFF, 0, 0, 0, 0, 0], emu.registers)
+        self.assertEqual(17, emu.cycles)
+
+    def test_r0_and_memory(self):
+        emu = Risc16Emulator()
+        emu.load_assembler(risc16.Risc16AssemblerTests.assemble([
+            'addi 0,0,5',
+            'lui 1,1023',
+            'addi 1,1,-1',
+            'nand 2,1,1',
+            'sw 2,0,data',
+            'lw 3,0,data',
+            'halt',
+            'data: .fill 0',
+        ]))
+        emu.run()
+        self.assertEqual(0, emu.registers[0])
+        self.assertEqual(0xFFBF, emu.registers[1])
+        self.assertEqual(0x0040, emu.registers[2])
+        self.assertEqual(0x0040, emu.memory[7])
+        self.assertEqual(0x0040, emu.registers[3])
+
+    def test_jalr_and_budget(self):
+        emu = Risc16Emulator()
+        emu.load_assembler(risc16.Risc16AssemblerTests.assemble([
+            'lw 1,0,target',
+            'jalr 7,1,0',
+            'halt',
+            'sub: addi 2,2,1',
+            'jalr 0,7,0',
+            'target: .fill sub',
+        ]))
+        self.assertEqual(3, emu.run(max_cycles=3))
+        self.assertFalse(emu.halted)
+        emu.run()
+        self.assertTrue(emu.halted)
+        self.assertEqual(1, emu.registers[2])
+        self.assertEqual(2, emu.registers[7])
+
+    def test_output_formats(self):
+        asb = risc16.Risc16AssemblerTests.assemble(['lw 1,0,count', 'addi 1,1,-1', 'halt', 'count: .fill -2'])
+        with tempfile.TemporaryDirectory() as directory:
+            for name, output_format in (('count.bin', 'text'), ('count.img', 'raw'), ('count.hex', 'hex')):
+                asb.output_binary(os.path.join(directory, name), output_format)
+                emu = Risc16Emulator()
+                emu.input_binary(os.path.join(directory, name))
+                self.assertEqual([int(word) for word in asb.output], emu.memory[:emu.program_size].tolist())
+
+    def test_image_and_mapped_memory(self):
+        # the count lives past the program, loading the program over mapped memory leaves it alone
+        asb = risc16.Risc16AssemblerTests.assemble(['lw 1,0,20', 'addi 1,1,1', 'sw 1,0,20', 'halt'])
+        with tempfile.TemporaryDirectory() as directory:
+            write_words(os.path.join(directory, 'count.img'), asb.output)
+            emu = Risc16Emulator()
+            emu.map_memory(os.path.join(directory, 'memory.img'))
+            emu.input_image(os.path.join(directory, 'count.img'))
+            emu.run()
+            self.assertEqual(1, emu.memory[20])
+            del emu
+            # reload the saved memory over the same program and carry on counting, loading before and after mapping
+            for count in (2, 3):
+                emu = Risc16Emulator()
+                if count == 2:
+                    emu.input_image(os.path.join(directory, 'count.img'))
+                    emu.map_memory(os.path.join(directory, 'memory.img'))
+                else:
+                    emu.map_memory(os.path.join(directory, 'memory.img'))
+                    emu.input_image(os.path.join(directory, 'count.img'))
+                emu.run()
+                self.assertEqual(count, emu.memory[20])
+                self.assertEqual(count, map_words(os.path.join(directory, 'memory.img'))[20])
+                del emu
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('program', metavar='xxx.risc16|xxx.bin|xxx.img|xxx.hex', type=str, nargs='?', default='sample.risc16', help='assembly, binary, packed image or Intel HEX file to run')
+    parser.add_argument('--cycles', '-n', action='store', type=int, default=None, help="maximum number of cycles to run")
+    parser.add_argument('--memory', action='store', default=None, help="file to map memory onto, created if missing")
+    args = parser.parse_args()
+
+    emu = Risc16Emulator()
+    if args.memory:
+        emu.map_memory(args.memory)
+    if args.program.endswith('.risc16'):
+        asb = Risc16Assembler()
+        asb.input_assembly(args.program)
+        emu.load_assembler(asb)
+    elif args.program.endswith('.img'):
+        emu.input_image(args.program)
+    else:
+        emu.input_binary(args.program)
+    emu.run(args.cycles)
+    print(emu.dump_state(range(emu.program_size)))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import unittest
+
+import risc16
+from risc16 import Risc16Assembler
+from risc16emulator import Risc16Emulator, WORD_MASK
+risc16_log = logging.getLogger('risc16')
+
+# handler name -> (source register fields, writes regA), fields are 'a', 'b' or 'c'
+operand_fields = {
+    'nop': ((), False),
+    'add': (('b', 'c'), True),
+    'addi': (('b',), True),
+    'nand': (('b', 'c'), True),
+    'lui': ((), True),
+    'sw': (('a', 'b'), False),
+    'lw': (('b',), True),
+    'beq': (('a', 'b'), False),
+    'jalr': (('b',), True),
+    'jr': (('b',), False),
+    'halt': ((), False),
+    'syscall': ((), False),
+    # fetched past the end of the program
+    'end': ((), False),
+}
+
+
+class Instruction:
+    __slots__ = ('pc', 'op', 'a', 'b', 'imm', 'sources', 'dest', 'operands', 'value', 'address')
+
+    def __init__(self, pc, op, a, b, imm):
+        self.pc = pc
+        self.op = op
+        self.a = a
+        self.b = b
+        self.imm = imm
+        fields, writes = operand_fields[op]
+        self.sources = tuple({'a': a, 'b': b, 'c': imm}[field] for field in fields)
+        # r0 is hardwired to 0, an instruction writing it has no destination
+        self.dest = a if writes and a else None
+        self.operands = ()
+        self.value = 0
+        self.address = 0
+
+    def __str__(self):
+        return f"{self.pc}: {self.op} {self.a},{self.b},{self.imm}"
+
+
+class Risc16Pipeline(Risc16Emulator):
+    """
+    Cycle level model of the classic 5 stage RiSC-16 pipeline: fetch, decode, execute, memory, writeback.  Results
+    are forwarded to execute from the execute/memory and memory/writeback latches, writeback writes the register
+    file before decode reads it, a load followed by a use stalls decode for one clock, and branches are predicted
+    not taken and resolved in execute, flushing the two younger instructions when taken.
+    run() executes in the detailed pipeline, fast_forward() at functional emulator speed; both work on the same
+    registers, memory and PC, so a run can fast forward to the region of interest and continue in detail.
+    """
+    def __init__(self):
+        super(Risc16Pipeline, self).__init__()
+        self.clocks = 0
+        self.stalls = 0
+        self.flushes = 0
+        self.forwards = 0
+
+    def reset(self):
+        super(Risc16Pipeline, self).reset()
+        self.clocks = 0
+        self.stalls = 0
+        self.flushes = 0
+        self.forwards = 0
+
+    def fast_forward(self, count):
+        return super(Risc16Pipeline, self).run(count)
+
+    def fetch(self, pc):
+        if pc >= self.program_size:
+            return Instruction(pc, 'end', 0, 0, 0)
+        handler, a, b, imm = self.decode(self.memory[pc])
+        return Instruction(pc, handler.__name__, a, b, imm)
+
+    def forward(self, instruction, ex_mem, mem_wb):
+        operands = []
+        for register, value in zip(instruction.sources, instruction.operands):
+            if ex_mem is not None and ex_mem.dest == register:
+                value = ex_mem.value
+                self.forwards += 1
+            elif mem_wb is not None and mem_wb.dest == register:
+                value = mem_wb.value
+                self.forwards += 1
+            operands.append(value)
+        return operands
+
+    def execute(self, instruction, ex_mem, mem_wb):
+        # returns the redirected fetch PC, or None to keep fetching in order
+        op = instruction.op
+        operands = self.forward(instruction, ex_mem, mem_wb)
+        if op in ('add', 'nand'):
+            x, y = operands
+            instruction.value = (x + y) & WORD_MASK if op == 'add' else ~(x & y) & WORD_MASK
+        elif op == 'addi':
+            instruction.value = (operands[0] + instruction.imm) & WORD_MASK
+        elif op == 'lui':
+            instruction.value = (instruction.imm << 6) & WORD_MASK
+        elif op == 'lw':
+            instruction.address = (operands[0] + instruction.imm) & WORD_MASK
+        elif op == 'sw':
+            instruction.value = operands[0]
+            instruction.address = (operands[1] + instruction.imm) & WORD_MASK
+        elif op == 'beq':
+            if operands[0] == operands[1]:
+                return (instruction.pc + 1 + instruction.imm) & WORD_MASK
+        elif op in ('jalr', 'jr'):
+            instruction.value = instruction.pc + 1
+            return operands[0]
+        return None
+
+    def access_memory(self, instruction):
+        if instruction.op == 'lw':
+            instruction.value = self.memory[instruction.address]
+        elif instruction.op == 'sw':
+            self.memory[instruction.address] = instruction.value
+            if instruction.address < len(self.decoded):
+                # self-modifying code, keep the functional decode table coherent
+                self.decoded[instruction.address] = self.decode(instruction.value)
+
+    def run(self, max_cycles=None):
+        # max_cycles counts retired instructions, like the functional emulator, clocks are counted separately
+        if self.halted:
+            return 0
+        regs = self.registers
+        pc = self.pc
+        if_id = id_ex = ex_mem = mem_wb = None
+        fetching = True
+        retired = 0
+        while retired != max_cycles:
+            self.clocks += 1
+            # writeback, first so decode reads the value written this clock
+            if mem_wb is not None:
+                if mem_wb.op in ('halt', 'syscall', 'end'):
+                    if mem_wb.op == 'syscall':
+                        risc16_log.error(f"unsupported system call {mem_wb.imm} at {mem_wb.pc} treated as halt")
+                    if mem_wb.op != 'end':
+                        retired += 1
+                    self.halted = True
+                    pc = mem_wb.pc
+                    if_id = id_ex = ex_mem = mem_wb = None
+                    break
+                if mem_wb.dest is not None:
+                    regs[mem_wb.dest] = mem_wb.value
+                retired += 1
+                if retired == max_cycles:
+                    # squash everything younger, nothing after writeback has touched architectural state yet
+                    mem_wb = None
+                    break
+            # every stage below reads the latches as they were at the start of the clock
+            next_mem_wb = ex_mem
+            if ex_mem is not None:
+                self.access_memory(ex_mem)
+            next_ex_mem = id_ex
+            redirect = None
+            if id_ex is not None:
+                redirect = self.execute(id_ex, ex_mem, mem_wb)
+                if id_ex.op in ('halt', 'syscall', 'end'):
+                    fetching = False
+            stall = (id_ex is not None and id_ex.op == 'lw' and if_id is not None and
+                     id_ex.dest is not None and id_ex.dest in if_id.sources)
+            if stall:
+                self.stalls += 1
+                next_id_ex = None
+                next_if_id = if_id
+            else:
+                next_id_ex = if_id
+                if if_id is not None:
+                    if_id.operands = tuple(regs[register] for register in if_id.sources)
+                next_if_id = self.fetch(pc) if fetching else None
+                if fetching:
+                    pc = (pc + 1) & WORD_MASK
+            if redirect is not None or not fetching:
+                # squash the instructions fetched down the wrong path
+                self.flushes += (next_if_id is not None) + (next_id_ex is not None)
+                next_if_id = next_id_ex = None
+                if redirect is not None:
+                    pc = redirect
+            if_id, id_ex, ex_mem, mem_wb = next_if_id, next_id_ex, next_ex_mem, next_mem_wb
+        if not self.halted:
+            # the architectural PC is that of the oldest instruction still in flight
+            for instruction in (mem_wb, ex_mem, id_ex, if_id):
+                if instruction is not None:
+                    pc = instruction.pc
+                    break
+        self.pc = pc
+        self.cycles += retired
+        return retired
+
+    def dump_state(self, memory_range=()):
+        r = super(Risc16Pipeline, self).dump_state(memory_range)
+        r += f"clocks: {self.clocks}\nstalls: {self.stalls}\nflushes: {self.flushes}\nforwards: {self.forwards}\n"
+        return r
+
+
+class Risc16PipelineTests(unittest.TestCase):
+    programs = [
+        ['        lw 1,0,count',
+         '        lw r2,1,2',
+         'start:  add 1,1,2',
+         '        beq 0,1,1',
+         '        beq 0,0,start',
+         'done:   halt',
+         'count:  .fill 5',
+         'neg1:   .fill -1'],
+        ['addi 1,0,3', 'addi 2,1,4', 'add 3,2,1', 'nand 4,3,3', 'sw 4,0,data', 'lw 5,0,data', 'add 6,5,5',
+         'lui 7,3', 'lw 1,0,target', 'jalr 7,1,0', 'halt', 'sub: addi 2,2,1', 'jalr 0,7,0',
+         'target: .fill sub', 'data: .fill 0'],
+        ['addi 1,0,2', 'loop: addi 1,1,-1', 'beq 1,0,out', 'beq 0,0,loop', 'out: sw 1,0,9', 'addi 2,0,7'],
+    ]
+
+    def assert_matches_emulator(self, lines, max_cycles=None, fast_forward=0):
+        asb = risc16.Risc16AssemblerTests.assemble(lines)
+        reference = Risc16Emulator()
+        reference.load_assembler(asb)
+        reference.run(max_cycles)
+        pipeline = Risc16Pipeline()
+        pipeline.load_assembler(asb)
+        pipeline.fast_forward(fast_forward)
+        pipeline.run(None if max_cycles is None else max(max_cycles - fast_forward, 0))
+        memory_range = range(len(asb.output) + 2)
+        self.assertEqual(reference.dump_state(memory_range),
+                         Risc16Emulator.dump_state(pipeline, memory_range))
+        return pipeline
+
+    def test_matches_emulator(self):
+        for lines in self.programs:
+            for max_cycles in list(range(20)) + [None]:
+                self.assert_matches_emulator(lines, max_cycles)
+
+    def test_fast_forward(self):
+        for lines in self.programs:
+            for fast_forward in range(20):
+                self.assert_matches_emulator(lines, fast_forward=fast_forward)
+
+    def test_hazard_accounting(self):
+        pipeline = self.assert_matches_emulator(self.programs[0])
+        # 2 instructions of setup, 5 trips round the loop and the halt
+        self.assertEqual(17, pipeline.cycles)
+        # lw r2 uses r1 straight after it is loaded, and the loop's add uses r2 straight after it too
+        self.assertEqual(2, pipeline.stalls)
+        # four taken back edges and the branch out of the loop squash two instructions each, the halt one more
+        self.assertEqual(11, pipeline.flushes)
+        # fill (4 clocks) + one clock per instruction + stalls + two bubbles per taken branch
+        self.assertEqual(4 + 17 + 2 + 2 * 5, pipeline.clocks)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('program', metavar='xxx.risc16|xxx.bin', type=str, nargs='?', default='sample.risc16', help='assembly or binary file to run')
+    parser.add_argument('--fast-forward', '-f', action='store', type=int, default=0, help="instructions to run functionally before the detailed pipeline")
+    parser.add_argument('--cycles', '-n', action='store', type=int, default=None, help="maximum number of instructions to run in the detailed pipeline")
+    args = parser.parse_args()
+
+    pipeline = Risc16Pipeline()
+    if args.program.endswith('.risc16'):
+        asb = Risc16Assembler()
+        asb.input_assembly(args.program)
+        pipeline.load_assembler(asb)
+    else:
+        pipeline.input_binary(args.program)
+    pipeline.fast_forward(args.fast_forward)
+    pipeline.run(args.cycles)
+    print(pipeline.dump_state(range(pipeline.program_size)))
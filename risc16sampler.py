@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import risc16
+from risc16 import Risc16Assembler
+from risc16emulator import Risc16Emulator
+from risc16pipeline import Risc16Pipeline
+risc16_log = logging.getLogger('risc16')
+
+# per interval counters summed into the whole program estimate
+interval_stats = ('instructions', 'clocks', 'stalls', 'flushes', 'forwards')
+
+
+def take_checkpoints(program, interval, max_cycles=None, period=1):
+    """
+    Functional pass over the whole program, checkpointing the architectural state at the start of every period-th
+    interval of interval instructions; the others are never simulated in detail, so aren't kept.  Returns the
+    checkpoints, the number of instructions the program ran and the number of intervals.
+    """
+    emu = Risc16Emulator()
+    emu.load_program(program)
+    checkpoints = []
+    intervals = 0
+    while not emu.halted and (max_cycles is None or emu.cycles < max_cycles):
+        if intervals % period == 0:
+            checkpoints.append(emu.checkpoint())
+        intervals += 1
+        budget = interval if max_cycles is None else min(interval, max_cycles - emu.cycles)
+        if not emu.run(budget):
+            break
+    return checkpoints, emu.cycles, intervals
+
+
+def simulate_interval(program, checkpoint, length):
+    # runs in a worker process, so it takes and returns only plain picklable values
+    pipeline = Risc16Pipeline()
+    pipeline.load_program(program)
+    pipeline.restore(checkpoint)
+    instructions = pipeline.run(length)
+    return {'instructions': instructions, 'clocks': pipeline.clocks, 'stalls': pipeline.stalls,
+            'flushes': pipeline.flushes, 'forwards': pipeline.forwards}
+
+
+def sample(program, interval=10000, period=10, workers=None, max_cycles=None):
+    """
+    Sampled simulation: checkpoints every interval instructions in a functional pass, then runs every period-th
+    interval through the detailed pipeline, spread across worker processes, and scales the measured counters up to
+    the whole program.  Each sampled interval starts with an empty pipeline, so short intervals overestimate clocks
+    by the few cycles it takes to fill.
+    """
+    program = [int(word) for word in program]
+    checkpoints, total, intervals = take_checkpoints(program, interval, max_cycles, period)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(simulate_interval, repeat(program), checkpoints, repeat(interval), chunksize=1))
+    measured = {stat: sum(result[stat] for result in results) for stat in interval_stats}
+    scale = total / measured['instructions'] if measured['instructions'] else 0
+    estimate = {stat: round(measured[stat] * scale) for stat in interval_stats}
+    estimate['instructions'] = total
+    estimate['cpi'] = measured['clocks'] / measured['instructions'] if measured['instructions'] else 0
+    estimate['intervals'] = intervals
+    estimate['sampled'] = len(checkpoints)
+    return estimate
+
+
+class Risc16SamplerTests(unittest.TestCase):
+    lines = [
+        '        lw 1,0,outer',
+        'o:      lw 2,0,inner',
+        'i:      lw 3,0,acc',
+        '        add 3,3,2',
+        '        sw 3,0,acc',
+        '        addi 2,2,-1',
+        '        beq 2,0,next',
+        '        beq 0,0,i',
+        'next:   addi 1,1,-1',
+        '        beq 1,0,done',
+        '        beq 0,0,o',
+        'done:   halt',
+        'outer:  .fill 30',
+        'inner:  .fill 20',
+        'acc:    .fill 0',
+    ]
+
+    def test_checkpoints_resume(self):
+        asb = risc16.Risc16AssemblerTests.assemble(self.lines)
+        reference = Risc16Emulator()
+        reference.load_assembler(asb)
+        reference.run()
+        checkpoints, total, intervals = take_checkpoints(asb.output, 500)
+        self.assertEqual(reference.cycles, total)
+        self.assertEqual(-(-total // 500), len(checkpoints))
+        self.assertEqual(len(checkpoints), intervals)
+        sparse, _, _ = take_checkpoints(asb.output, 500, period=3)
+        self.assertEqual(checkpoints[::3], sparse)
+        emu = Risc16Emulator()
+        emu.load_assembler(asb)
+        emu.restore(checkpoints[3])
+        self.assertEqual(1500, emu.cycles)
+        emu.run()
+        self.assertEqual(reference.dump_state(range(len(asb.output))), emu.dump_state(range(len(asb.output))))
+
+    def test_estimate(self):
+        asb = risc16.Risc16AssemblerTests.assemble(self.lines)
+        pipeline = Risc16Pipeline()
+        pipeline.load_assembler(asb)
+        pipeline.run()
+        every = sample(asb.output, interval=400, period=1, workers=2)
+        self.assertEqual(pipeline.cycles, every['instructions'])
+        self.assertEqual(every['intervals'], every['sampled'])
+        # every interval sampled, only the pipeline fill and drain at interval boundaries differ from the full run
+        self.assertLessEqual(abs(every['clocks'] - pipeline.clocks), 4 * every['intervals'])
+        self.assertLessEqual(abs(every['stalls'] - pipeline.stalls), every['intervals'])
+        sampled = sample(asb.output, interval=200, period=4, workers=2)
+        self.assertEqual(pipeline.cycles, sampled['instructions'])
+        self.assertEqual(-(-sampled['intervals'] // 4), sampled['sampled'])
+        self.assertLess(abs(sampled['clocks'] - pipeline.clocks), pipeline.clocks * 0.05)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="""""", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog,max_help_position=80))
+    parser.add_argument('program', metavar='xxx.risc16|xxx.bin', type=str, nargs='?', default='sample.risc16', help='assembly or binary file to run')
+    parser.add_argument('--interval', '-k', action='store', type=int, default=10000, help="instructions between checkpoints")
+    parser.add_argument('--period', '-p', action='store', type=int, default=10, help="simulate every p-th interval in detail")
+    parser.add_argument('--workers', '-j', action='store', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--cycles', '-n', action='store', type=int, default=None, help="maximum number of instructions to run")
+    args = parser.parse_args()
+
+    if args.program.endswith('.risc16'):
+        asb = Risc16Assembler()
+        asb.input_assembly(args.program)
+        program = asb.output
+    else:
+        emu = Risc16Emulator()
+        emu.input_binary(args.program)
+        program = emu.memory[:emu.program_size]
+    for stat, value in sample(program, args.interval, args.period, args.workers, args.cycles).items():
+        print(f"{stat}: {value}")
@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 import argparse
 import logging
-from constructs import Register, Wire
-import BitVector as b
+from constructs import Register, Scheduler, Wire, Word
 logging.basicConfig(level=logging.INFO)
 simulator_log = logging.getLogger('simulator')
 # instantiate all modules in the CPU
@@ -10,21 +9,15 @@ simulator_log = logging.getLogger('simulator')
 # load code from memory
 # go! (simulate clock ticks simultaneously across all modules)
 
-tick_count = 0
-tick_list = []
+scheduler = Scheduler()
 
 
 def state():
-    print(f"TICK: {tick_count}")
-    for x in tick_list:
-        print(x)
+    print(scheduler)
 
 
 def tick():
-    global tick_count
-    tick_count += 1
-    for x in tick_list:
-        x.tick()
+    scheduler.tick()
 
 
 if __name__ == "__main__":
@@ -46,23 +39,23 @@ if __name__ == "__main__":
     fetched_instruction = Wire(size=asb.isa.word_size)
 
     PC = Register(name='Program Counter', size=asb.isa.word_size, _in=pc_value)
-    tick_list.append(PC)
+    scheduler.add(PC)
 
 ### FETCH ###
 
-    instruction_memory = asb.output
+    instruction_memory = [Word(int(word), asb.isa.word_size) for word in asb.output]
     FD_inst = Register(name='Fetched Instruction', size=asb.isa.word_size, _in=fetched_instruction)
     FD_pc = Register(name='Fetch/Decode PC', size=asb.isa.word_size, _in=PC.output)
-    tick_list.extend([FD_pc, FD_inst])
+    scheduler.add(FD_pc, FD_inst)
 
 ### DECODE ###
 
     DE_pc = Register(name='Decode/Execute PC', size=asb.isa.word_size, _in=FD_pc.output)
-    tick_list.append(DE_pc)
+    scheduler.add(DE_pc)
 
 ### EXECUTE ###
     EM_pc = Register(name='Execute/Memory PC', size=asb.isa.word_size, _in=DE_pc.output)
-    tick_list.append(EM_pc)
+    scheduler.add(EM_pc)
 
 ### MEMORY ###
     # data_mux = _logic()
@@ -74,7 +67,7 @@ if __name__ == "__main__":
     pc = 0
     state()
     for i in range(5):
-        pc_value.set(b.BitVector(intVal=pc, size=asb.isa.word_size))
+        pc_value.set(Word(pc, asb.isa.word_size))
         tick()
         state()
         pc += 1
@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+
+from components import AND, OR, NOT, XOR, XNOR, Logic, Netlist, HalfAdder, FullAdder, NAND, NOR
+
+
+def exactly_one(inputs):
+    return np.count_nonzero(inputs, axis=0) == 1
+
+
+# numpy versions of the primitive gates, each takes a list of boolean columns and returns one column
+array_gates = {
+    AND: lambda inputs: np.logical_and.reduce(inputs),
+    OR: lambda inputs: np.logical_or.reduce(inputs),
+    NOT: lambda inputs: np.logical_not(inputs[0]),
+    XOR: exactly_one,
+    XNOR: lambda inputs: ~exactly_one(inputs),
+}
+
+
+def evaluate(component, columns):
+    """
+    Evaluates a gate, Logic or Netlist over boolean input columns (one array per input, one row per vector), with
+    one vectorized operation per gate.  Returns a list of output columns.
+    """
+    if isinstance(component, Netlist):
+        values = list(columns) + [None] * (len(component.net_index) - len(columns))
+        for gate, inputs, output in component.schedule:
+            values[output] = evaluate(gate, [values[i] for i in inputs])[0]
+        return [values[o] for o in component.output_indices]
+    if isinstance(component, Logic):
+        if component.gates:
+            for gate in component.gates:
+                columns = evaluate(gate, columns)
+            return columns
+        return evaluate(component.netlist, columns)
+    return [array_gates[type(component)](columns)]
+
+
+def input_count(component, default=2):
+    # NOT, or a chain starting with it, takes one input, other gate chains (NAND, NOR) and primitives any number
+    if isinstance(component, Netlist):
+        return len(component.inputs)
+    if isinstance(component, Logic) and component.netlist:
+        return len(component.netlist.inputs)
+    if isinstance(component, Logic) and component.gates:
+        return input_count(component.gates[0], default)
+    if isinstance(component, NOT):
+        return 1
+    return default
+
+
+def input_matrix(count):
+    # every input vector in truth table order, input 0 is the most significant
+    rows = np.arange(1 << count)
+    shifts = np.arange(count - 1, -1, -1)
+    return ((rows[:, None] >> shifts) & 1).astype(bool)
+
+
+def outputs(component, inputs):
+    """
+    Outputs of the component for a (rows, inputs) matrix of input vectors, as a (rows, outputs) boolean array.
+    """
+    inputs = np.asarray(inputs, dtype=bool)
+    columns = evaluate(component, [inputs[:, i] for i in range(inputs.shape[1])])
+    return np.stack([np.broadcast_to(column, inputs.shape[:1]) for column in columns], axis=1)
+
+
+def truth_table(component, inputs=None, count=None):
+    """
+    Full truth table of the component as a (2**inputs, inputs + outputs) boolean array, rows in counting order.
+    Given a matrix of input vectors, returns only the outputs over those vectors.
+    """
+    if inputs is not None:
+        return outputs(component, inputs)
+    matrix = input_matrix(count if count is not None else input_count(component))
+    return np.concatenate([matrix, outputs(component, matrix)], axis=1)
+
+
+class TruthTableTests(unittest.TestCase):
+    def test_full_adder(self):
+        table = truth_table(FullAdder())
+        self.assertEqual((8, 5), table.shape)
+        for row in table.astype(int):
+            self.assertEqual(tuple(row[3:]), FullAdder().input(tuple(row[:3])))
+
+    def test_matches_input(self):
+        for component, count in ((HalfAdder(), 2), (NAND(), 2), (NOR(), 3), (XOR(), 3), (XNOR(), 2), (NOT(), 1)):
+            table = truth_table(component, count=count).astype(int)
+            for row in table:
+                vector = row[0] if isinstance(component, NOT) else tuple(row[:count])
+                expected = component.input(vector)
+                self.assertEqual(expected if isinstance(expected, tuple) else (expected,), tuple(row[count:]))
+
+    def test_input_count(self):
+        self.assertEqual([[0, 1], [1, 0]], truth_table(NOT()).astype(int).tolist())
+        self.assertEqual((4, 3), truth_table(NAND()).shape)
+        self.assertEqual((8, 4), truth_table(XOR(), count=3).shape)
+
+    def test_supplied_inputs(self):
+        inputs = np.array([[1, 1, 1], [0, 1, 1], [1, 0, 0]])
+        self.assertEqual([[1, 1], [0, 1], [1, 0]], truth_table(FullAdder(), inputs).astype(int).tolist())